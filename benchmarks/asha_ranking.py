@@ -0,0 +1,64 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+Checks the promotion decisions of utils.asha.TrialScheduler in a temporary store: trials report
+their losses at the first rung in a random order, and a trial must be promoted exactly if its loss
+ranks within the best 1 / reduction_factor of the losses reported so far. Diverged trials, whose
+loss is NaN or infinite, must never be promoted, also if they report first. Exits with status 1
+on a wrong decision.
+
+Usage:
+    python benchmarks/asha_ranking.py
+    python benchmarks/asha_ranking.py --trials 50 --reduction-factor 4
+"""
+
+import argparse
+import contextlib
+import io
+import math
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "source"))
+from utils import asha
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=20, help="Trials with finite losses.")
+    parser.add_argument("--reduction-factor", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    losses = [rng.uniform(0.001, 0.1) for _ in range(args.trials)] + [math.nan, math.inf, -math.nan]
+    rng.shuffle(losses)
+    # A diverged trial that reports first must not be promoted by default
+    losses.insert(0, math.nan)
+
+    failures = []
+    with tempfile.TemporaryDirectory() as store_dir:
+        asha.write_config(store_dir, 1, args.reduction_factor)
+        reported = []
+        for trial, loss in enumerate(losses):
+            scheduler = asha.TrialScheduler(store_dir, f"trial{trial}", max_epochs=args.reduction_factor)
+            with contextlib.redirect_stdout(io.StringIO()):
+                promoted = scheduler.report(1, loss)
+            reported.append(loss if math.isfinite(loss) else math.inf)
+            rank = sum(other < reported[-1] for other in reported)
+            expected = math.isfinite(loss) and rank < math.ceil(len(reported) / args.reduction_factor)
+            if promoted != expected:
+                failures.append(f"trial {trial} with loss {loss} was {'promoted' if promoted else 'stopped'}")
+    print(f"{len(losses)} trials reported, {len(failures)} wrong decisions.")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
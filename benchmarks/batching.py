@@ -0,0 +1,72 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+Compares the batch throughput (samples/s) of the original TensorDataset + DataLoader over
+materialized windows, the DataLoader over a WindowDataset and the WindowBatcher used in train.py.
+Only batch production is timed, including the transfer to the device.
+
+Usage:
+    python benchmarks/batching.py --samples 500000 --batch-size 4096 --device cpu
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "source"))
+from dataset import WindowBatcher, WindowDataset, create_dataloader
+
+
+def measure(batches, device: torch.device, epochs: int) -> float:
+    """Returns the samples/s of iterating over batches for the given number of epochs."""
+    samples = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for X, y in batches:
+            X, y = X.to(device), y.to(device)
+            samples += len(X)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return samples / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=500000, help="Length of the synthetic signal.")
+    parser.add_argument("--input-size", type=int, default=150)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    inputs = torch.randn(args.samples)
+    targets = torch.randn(args.samples)
+    dataset = WindowDataset(inputs, targets, args.input_size)
+
+    windows = inputs.unfold(0, args.input_size, 1).unsqueeze(1).contiguous()
+    tensor_dataset = torch.utils.data.TensorDataset(windows, targets[args.input_size - 1:].unsqueeze(1))
+    variants = {
+        "TensorDataset + DataLoader": torch.utils.data.DataLoader(
+            tensor_dataset, batch_size=args.batch_size, shuffle=True
+        ),
+        "WindowDataset + DataLoader": create_dataloader(dataset, args.batch_size, shuffle=True),
+        "WindowBatcher": WindowBatcher(dataset, args.batch_size, shuffle=True, device=device),
+    }
+    if device.type == "cuda":
+        variants["WindowBatcher (pinned prefetch)"] = WindowBatcher(
+            dataset, args.batch_size, shuffle=True, device=device, device_resident=False
+        )
+
+    print(f"{len(dataset)} windows of {args.input_size} samples, batch size {args.batch_size}, device {device}")
+    for name, batches in variants.items():
+        print(f"{name:>32}: {measure(batches, device, args.epochs):14,.0f} samples/s")
+
+
+if __name__ == "__main__":
+    main()
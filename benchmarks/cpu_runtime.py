@@ -0,0 +1,90 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+Measures the total training throughput (samples/s) of several training processes that share the CPUs
+of a node, with the PyTorch default threads (each process uses all cores) and with config.setup_cpu_runtime,
+which divides the CPUs between the processes, with and without pinning. The processes divide the CPUs
+like processes started by torchrun (LOCAL_WORLD_SIZE), which corresponds to jobs that share a node and
+each get --cpus-per-task CPUs.
+
+Usage:
+    python benchmarks/cpu_runtime.py --processes 4 --seconds 10
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "source"))
+from model import NeuralNetwork
+from utils import config
+
+
+def _train(variant: str, local_rank: int, processes: int, args: argparse.Namespace, barrier, queue) -> None:
+    if variant != "default":
+        os.environ.update({"LOCAL_RANK": str(local_rank), "LOCAL_WORLD_SIZE": str(processes)})
+        config.setup_cpu_runtime(pin=variant == "tuned + pinned")
+    torch.manual_seed(local_rank)
+    model = NeuralNetwork(16, 12, 36)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    loss_fn = torch.nn.MSELoss()
+    X, y = torch.randn(args.batch_size, 1, args.input_size), torch.randn(args.batch_size, 1)
+
+    def step():
+        loss = loss_fn(model(X), y)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    step()
+    # All processes measure at the same time
+    barrier.wait()
+    steps = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.seconds:
+        step()
+        steps += 1
+    queue.put(steps * args.batch_size / (time.perf_counter() - start))
+
+
+def run(variant: str, args: argparse.Namespace) -> float:
+    """Runs the processes concurrently and returns their total samples/s."""
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(args.processes)
+    queue = context.Queue()
+    workers = [
+        context.Process(target=_train, args=(variant, local_rank, args.processes, args, barrier, queue))
+        for local_rank in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    total = sum(queue.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4, help="Concurrent training processes.")
+    parser.add_argument("--seconds", type=float, default=10.0, help="Measured training time per variant.")
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--input-size", type=int, default=150)
+    args = parser.parse_args()
+
+    print(f"{args.processes} processes on {len(config.available_cpus())} CPUs, default threads per process: {torch.get_num_threads()}")
+    results = {}
+    for variant in ["default", "tuned", "tuned + pinned"]:
+        results[variant] = run(variant, args)
+        print(f"{variant:>15}: {results[variant]:10.0f} samples/s  ({results[variant] / results['default']:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
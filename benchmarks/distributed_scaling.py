@@ -0,0 +1,95 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+Measures how the training throughput (samples/s) of DistributedDataParallel scales with the number
+of worker processes on the CPU with the gloo backend. Each worker trains on its shard of the
+WindowDataset with the per-process batch size and the given number of threads, as a SLURM task with
+--cpus-per-task would. The aggregate throughput counts the samples of all workers.
+
+Usage:
+    python benchmarks/distributed_scaling.py --world-sizes 1 2 4 --threads 1
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "source"))
+from dataset import WindowBatcher, WindowDataset
+from model import NeuralNetwork
+
+
+def worker(rank: int, world_size: int, args: argparse.Namespace, port: int, results) -> None:
+    torch.set_num_threads(args.threads)
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+    torch.manual_seed(0)
+    dataset = WindowDataset(torch.randn(args.samples), torch.randn(args.samples), args.input_size)
+    batcher = WindowBatcher(dataset, args.batch_size, shuffle=True, device=torch.device("cpu"),
+                            rank=rank, world_size=world_size)
+    model = torch.nn.parallel.DistributedDataParallel(NeuralNetwork(16, 12, 8))
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    loss_fn = torch.nn.MSELoss()
+
+    def train(max_batches: int) -> int:
+        samples = 0
+        for batch, (X, y) in enumerate(batcher):
+            if batch == max_batches:
+                break
+            loss = loss_fn(model(X), y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            samples += len(X)
+        return samples
+
+    train(args.warmup_batches)
+    dist.barrier()
+    start = time.perf_counter()
+    samples = train(args.batches)
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    totals = torch.tensor([samples, elapsed], dtype=torch.float64)
+    dist.all_reduce(totals[:1])
+    dist.all_reduce(totals[1:], op=dist.ReduceOp.MAX)
+    if rank == 0:
+        results[world_size] = totals[0].item() / totals[1].item()
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--world-sizes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=1, help="Threads per worker process.")
+    parser.add_argument("--samples", type=int, default=500000, help="Length of the synthetic signal.")
+    parser.add_argument("--input-size", type=int, default=150)
+    parser.add_argument("--batch-size", type=int, default=1024, help="Batch size per worker.")
+    parser.add_argument("--batches", type=int, default=30, help="Timed batches per worker.")
+    parser.add_argument("--warmup-batches", type=int, default=3)
+    parser.add_argument("--port", type=int, default=29510)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.threads} thread(s) and batch size {args.batch_size} per worker")
+    results = mp.Manager().dict()
+    baseline = None
+    for world_size in args.world_sizes:
+        mp.spawn(worker, args=(world_size, args, args.port + world_size, results), nprocs=world_size)
+        throughput = results[world_size]
+        baseline = baseline or throughput / world_size
+        print(f"{world_size:>3} worker(s): {throughput:12,.0f} samples/s, "
+              f"scaling efficiency {throughput / (baseline * world_size):6.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+Measures the time to import the modules that stages and the sweep engine load before doing any work,
+each in a fresh interpreter, like a DVC stage invocation. The lightweight modules must not import
+torch or numpy; the script exits with status 1 if one of them does or if its median import time
+exceeds --max-seconds. torch itself is measured for comparison.
+
+Usage:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --repeats 10 --max-seconds 0.5
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+SOURCE_DIR = Path(__file__).resolve().parents[1] / "source"
+# Modules used for parameter loading, environment handling, log archiving and sweeps
+LIGHTWEIGHT_MODULES = ["utils.config", "utils.logs", "utils.asha", "utils.data_cache", "utils.sweep"]
+HEAVY_PACKAGES = ["torch", "numpy"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+print(json.dumps({"seconds": time.perf_counter() - start, "loaded": [name for name in sys.argv[2:] if name in sys.modules]}))
+"""
+
+
+def measure(module: str, repeats: int) -> dict:
+    """Imports the module in repeats fresh interpreters and returns the median time and the heavy packages it loaded."""
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE, module, *HEAVY_PACKAGES], cwd=SOURCE_DIR, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        times.append(result["seconds"])
+    return {"seconds": statistics.median(times), "loaded": result["loaded"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5, help="Fresh interpreters per module.")
+    parser.add_argument("--max-seconds", type=float, default=0.5, help="Maximum median import time of a lightweight module.")
+    args = parser.parse_args()
+
+    failures = []
+    for module in LIGHTWEIGHT_MODULES + ["torch"]:
+        result = measure(module, args.repeats)
+        loaded = ", ".join(result["loaded"]) or "-"
+        print(f"{module:>18}: {1000 * result['seconds']:8.1f} ms  heavy packages loaded: {loaded}")
+        if module in LIGHTWEIGHT_MODULES:
+            if result["loaded"]:
+                failures.append(f"{module} imports {loaded}")
+            if result["seconds"] > args.max_seconds:
+                failures.append(f"{module} takes {result['seconds']:.3f} s to import")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
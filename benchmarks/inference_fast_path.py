@@ -0,0 +1,109 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+Checks that model.InferenceNetwork computes the same outputs as the NeuralNetwork it is derived from
+and compares their CPU latency for batch sizes from 1 to 4096, in eager mode, traced with TorchScript
+and, if onnxruntime is installed, exported to ONNX. With --conv1d-strides other than the kernel size
+(12) the fallback to the generic convolution is measured. Exits with status 1 if the maximum absolute
+difference of any variant exceeds the tolerance.
+
+Usage:
+    python benchmarks/inference_fast_path.py
+    python benchmarks/inference_fast_path.py --checkpoint models/checkpoints/model.pth --threads 1
+"""
+
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "source"))
+import export
+from model import InferenceNetwork, NeuralNetwork
+
+
+def _latency(run, inputs, min_seconds: float) -> float:
+    """Returns the median latency of run(inputs) in ms over at least min_seconds."""
+    run(inputs)
+    times = []
+    while len(times) < 5 or sum(times) < min_seconds:
+        start = time.perf_counter()
+        run(inputs)
+        times.append(time.perf_counter() - start)
+    return 1000 * statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", help="Trained weights, random weights if not given.")
+    parser.add_argument("--conv1d-filters", type=int, default=16)
+    parser.add_argument("--conv1d-strides", type=int, default=12)
+    parser.add_argument("--hidden-units", type=int, default=36)
+    parser.add_argument("--input-size", type=int, default=150)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16, 64, 256, 1024, 4096])
+    parser.add_argument("--seconds", type=float, default=0.5, help="Minimum measured time per variant and batch size.")
+    parser.add_argument("--threads", type=int, help="PyTorch and ONNX Runtime intra-op threads, the defaults if not given.")
+    parser.add_argument("--tolerance", type=float, default=1e-5)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    model = NeuralNetwork(args.conv1d_filters, args.conv1d_strides, args.hidden_units)
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location=torch.device("cpu")))
+    model.eval()
+    fast = InferenceNetwork(model, args.input_size)
+    print(f"Fast path: conv1 {'matmul' if fast.conv1.fast else 'generic'}, conv2 {'matmul' if fast.conv2.fast else 'generic'}, "
+          f"{torch.get_num_threads()} threads")
+
+    with warnings.catch_warnings():
+        # torch.jit.trace is deprecated in newer PyTorch versions than the pinned one
+        warnings.simplefilter("ignore")
+        traced = torch.jit.trace(fast, torch.rand(1, 1, args.input_size))
+    variants = {"NeuralNetwork": model, "InferenceNetwork": fast, "InferenceNetwork (TorchScript)": traced}
+    try:
+        import onnxruntime
+    except ImportError:
+        onnxruntime = None
+        print("onnxruntime is not installed, skipping the ONNX variants.")
+    if onnxruntime is not None:
+        options = onnxruntime.SessionOptions()
+        if args.threads:
+            options.intra_op_num_threads = args.threads
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, module in [("NeuralNetwork", model), ("InferenceNetwork", fast)]:
+                path = Path(tmp_dir) / f"{name}.onnx"
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    export.export_onnx(module, args.input_size, path)
+                session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+                variants[f"{name} (ONNX Runtime)"] = lambda x, session=session: torch.from_numpy(session.run(None, {"input": x.numpy()})[0])
+
+    failed = False
+    print(f"{'batch':>6} " + " ".join(f"{name:>32}" for name in variants) + "   max abs difference")
+    for batch_size in args.batch_sizes:
+        inputs = torch.rand(batch_size, 1, args.input_size) * 2 - 1
+        latencies = []
+        max_error = 0.0
+        with torch.no_grad():
+            reference = model(inputs)
+            for name, run in variants.items():
+                max_error = max(max_error, (run(inputs) - reference).abs().max().item())
+                latencies.append(_latency(run, inputs, args.seconds))
+        failed = failed or max_error > args.tolerance
+        print(f"{batch_size:>6} " + " ".join(f"{latency:>29.3f} ms" for latency in latencies) + f"   {max_error:.2e}")
+    if failed:
+        print(f"The outputs differ by more than the tolerance {args.tolerance}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+Benchmarks the preprocess, train and export stages on synthetic audio, so that changes to
+preprocess.py, model.py or train.py can be checked for speed regressions on a CPU-only machine.
+
+  preprocess   wall time and peak resident memory of preprocess.py, run in a fresh process
+  train        training samples/s of train_epoch for every model configuration and batch size
+  export       wall time of the ONNX export and the inference latency and throughput of the
+               exported model with onnxruntime (if installed) and of the PyTorch model
+
+The results are written as JSON. With --baseline they are compared with an earlier result file and
+the script exits with status 1 if a metric got worse by more than the tolerance.
+
+Usage:
+    python benchmarks/pipeline.py --seconds 30 --output benchmarks/baseline.json
+    python benchmarks/pipeline.py --seconds 30 --baseline benchmarks/baseline.json --tolerance 0.15
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "source"))
+import export
+import preprocess
+import train
+from dataset import WindowBatcher, WindowDataset, load_processed_data
+from model import InferenceNetwork, NeuralNetwork
+from preprocess_audio import write_synthetic_wav
+
+SAMPLE_RATE = 44100
+# Metrics where a larger value is better, all others are times or memory sizes
+HIGHER_IS_BETTER = ("samples_per_second",)
+
+
+def _run_preprocess(work_dir: str, queue: multiprocessing.Queue) -> None:
+    os.chdir(work_dir)
+    # The benchmark measures the decoding, not the preprocessing cache
+    os.environ["TUSTU_PREPROCESS_CACHE_SIZE"] = "0"
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        preprocess.main()
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is reported in KiB on Linux
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10))
+
+
+def benchmark_preprocess(work_dir: Path, seconds: float, input_size: int) -> dict:
+    """Writes synthetic input and target files and runs preprocess.py on them in a fresh process."""
+    gigabytes = seconds * SAMPLE_RATE * 4 / 2**30
+    for name in ("input", "target"):
+        write_synthetic_wav(work_dir / f"{name}.wav", gigabytes, SAMPLE_RATE)
+    with open(work_dir / "params.yaml", "w") as file:
+        json.dump({
+            "general": {"input_size": input_size},
+            "preprocess": {"input_file": str(work_dir / "input.wav"), "target_file": str(work_dir / "target.wav"), "test_split": 0.2, "split": "per_file", "workers": 1},
+        }, file)
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_preprocess, args=(str(work_dir), queue))
+    process.start()
+    elapsed, peak_rss = queue.get()
+    process.join()
+    return {"seconds": elapsed, "peak_rss_mib": peak_rss}
+
+
+def benchmark_train(data: dict, model_config: tuple, batch_size: int, epochs: int) -> dict:
+    """Measures the samples/s of train_epoch after a warm-up step."""
+    torch.manual_seed(0)
+    model = NeuralNetwork(*model_config)
+    loss_fn = torch.nn.MSELoss(reduction="mean")
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    training_dataset = WindowDataset(data["X_training"], data["y_training"], data["input_size"])
+    dataloader = WindowBatcher(training_dataset, batch_size=batch_size, shuffle=True, device=torch.device("cpu"))
+    X, y = next(iter(dataloader))
+    loss_fn(model(X), y).backward()
+    optimizer.zero_grad()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for epoch in range(epochs):
+            train.train_epoch(dataloader, model, loss_fn, optimizer, torch.device("cpu"), None, epoch, log_interval=100)
+    elapsed = time.perf_counter() - start
+    return {"samples_per_second": epochs * len(training_dataset) / elapsed}
+
+
+def _latency(run, inputs, repeats: int) -> dict:
+    run(inputs)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run(inputs)
+        times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+    return {"latency_ms": 1000 * median, "samples_per_second": len(inputs) / median}
+
+
+def benchmark_export(work_dir: Path, model_config: tuple, input_size: int, batch_sizes: list, repeats: int) -> dict:
+    """Exports the model to ONNX and measures the inference of the exported and the PyTorch model per batch size."""
+    torch.manual_seed(0)
+    model = NeuralNetwork(*model_config).eval()
+    onnx_path = work_dir / "model.onnx"
+    start = time.perf_counter()
+    export.export_onnx(InferenceNetwork(model, input_size), input_size, onnx_path)
+    results = {"export": {"seconds": time.perf_counter() - start}}
+
+    try:
+        import onnxruntime
+    except ImportError:
+        onnxruntime = None
+        print("onnxruntime is not installed, skipping the ONNX inference benchmark.")
+    if onnxruntime is not None:
+        session = onnxruntime.InferenceSession(str(onnx_path), providers=["CPUExecutionProvider"])
+        for batch_size in batch_sizes:
+            inputs = torch.rand(batch_size, 1, input_size).numpy()
+            results[f"inference/onnxruntime/b{batch_size}"] = _latency(lambda x: session.run(None, {"input": x}), inputs, repeats)
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            inputs = torch.rand(batch_size, 1, input_size)
+            results[f"inference/torch/b{batch_size}"] = _latency(model, inputs, repeats)
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares the metrics of two result files.
+
+    Returns:
+        list: The regressions as (benchmark, metric, baseline value, new value).
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            if base is None or base == 0:
+                continue
+            change = value / base - 1
+            higher_is_better = metric in HIGHER_IS_BETTER
+            regressed = change < -tolerance if higher_is_better else change > tolerance
+            print(f"{name:>40} {metric:>20}: {base:12.4g} -> {value:12.4g} ({change:+7.1%}){'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append((name, metric, base, value))
+    return regressions
+
+
+def parse_model_config(text: str) -> tuple:
+    """Parses 'filters:strides:hidden_units' into the arguments of NeuralNetwork."""
+    filters, strides, hidden_units = (int(value) for value in text.split(":"))
+    return filters, strides, hidden_units
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=30.0, help="Length of the synthetic audio files.")
+    parser.add_argument("--input-size", type=int, default=150)
+    parser.add_argument("--models", nargs="+", type=parse_model_config, default=[(16, 12, 36), (16, 12, 64)],
+                        help="Model configurations as conv1d_filters:conv1d_strides:hidden_units (conv1d_filters must be 16).")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1024, 4096], help="Training batch sizes.")
+    parser.add_argument("--epochs", type=int, default=1, help="Timed training epochs per configuration.")
+    parser.add_argument("--inference-batch-sizes", nargs="+", type=int, default=[1, 64, 4096])
+    parser.add_argument("--repeats", type=int, default=20, help="Timed inference runs per batch size.")
+    parser.add_argument("--output", default="benchmarks/results.json", help="The JSON file for the results.")
+    parser.add_argument("--baseline", default=None, help="A result file to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change that counts as a regression.")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = Path(tmp_dir)
+        results["preprocess"] = benchmark_preprocess(work_dir, args.seconds, args.input_size)
+        print(f"preprocess: {results['preprocess']['seconds']:.2f} s, peak RSS {results['preprocess']['peak_rss_mib']:.1f} MiB")
+
+        data = load_processed_data(work_dir / "data" / "processed")
+        # Read the memory-mapped signals once, so that page faults are not part of the first configuration
+        data["X_training"] = [part.clone() for part in data["X_training"]]
+        data["y_training"] = [part.clone() for part in data["y_training"]]
+        for model_config in args.models:
+            for batch_size in args.batch_sizes:
+                name = "train/f{}_s{}_h{}/b{}".format(*model_config, batch_size)
+                results[name] = benchmark_train(data, model_config, batch_size, args.epochs)
+                print(f"{name}: {results[name]['samples_per_second']:.0f} samples/s")
+
+        export_results = benchmark_export(work_dir, args.models[0], args.input_size, args.inference_batch_sizes, args.repeats)
+        for name, metrics in export_results.items():
+            print(f"{name}: " + ", ".join(f"{metric} {value:.4g}" for metric, value in metrics.items()))
+        results.update(export_results)
+
+    output = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        },
+        "results": results,
+    }
+    output_path = Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as file:
+        json.dump(output, file, indent=2)
+    print(f"Results written to {output_path}.")
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        if baseline["meta"]["args"] != json.loads(json.dumps(output["meta"]["args"])):
+            print("Warning: the baseline was measured with different arguments.")
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.tolerance:.0%}.")
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
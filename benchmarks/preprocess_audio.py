@@ -0,0 +1,95 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+Compares the in-memory and the streaming audio loading of preprocess.py on a synthetic WAV file.
+Each variant runs in a fresh process so that its peak resident memory can be measured.
+The streaming variant writes to a np.memmap, whose file-backed pages count towards the peak RSS
+but not towards the anonymous RSS.
+
+Usage:
+    python benchmarks/preprocess_audio.py --gigabytes 2
+"""
+
+import argparse
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from pedalboard.io import AudioFile
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "source"))
+import preprocess
+
+
+def write_synthetic_wav(path: Path, gigabytes: float, sample_rate: int = 44100) -> int:
+    """Writes a mono float32 WAV of the requested size chunk by chunk and returns its number of frames."""
+    frames = int(gigabytes * 2**30 / 4)
+    rng = np.random.default_rng(0)
+    with AudioFile(str(path), "w", sample_rate, 1, bit_depth=32) as f:
+        written = 0
+        while written < frames:
+            n = min(preprocess.CHUNK_FRAMES, frames - written)
+            f.write(rng.uniform(-0.5, 0.5, size=(1, n)).astype(np.float32))
+            written += n
+    return frames
+
+
+def _run(variant: str, wav_path: str, out_path: str, queue: multiprocessing.Queue) -> None:
+    start = time.perf_counter()
+    if variant == "in_memory":
+        data = preprocess.load_and_process_audio(wav_path)
+    else:
+        with AudioFile(wav_path) as f:
+            length = f.frames * f.num_channels
+        out = np.memmap(out_path, dtype=np.float32, mode="w+", shape=(length,))
+        data = preprocess.stream_and_process_audio(wav_path, out=out)
+        data.flush()
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is reported in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    queue.put((elapsed, peak_rss, _anonymous_rss(), float(data[-1])))
+
+
+def _anonymous_rss() -> float:
+    """Resident anonymous memory in MiB, i.e. without the reclaimable file-backed pages of a memmap."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) / 2**10
+    return float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gigabytes", type=float, default=2.0, help="Size of the synthetic WAV file.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        wav_path = Path(tmp_dir) / "synthetic.wav"
+        frames = write_synthetic_wav(wav_path, args.gigabytes)
+        print(f"Synthetic WAV: {frames} frames, {wav_path.stat().st_size / 2**30:.2f} GiB")
+
+        results = {}
+        for variant in ["in_memory", "streaming"]:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_run, args=(variant, str(wav_path), str(Path(tmp_dir) / "out.f32"), queue)
+            )
+            process.start()
+            results[variant] = queue.get()
+            process.join()
+            elapsed, peak_rss, anonymous_rss, _ = results[variant]
+            print(f"{variant:>10}: {elapsed:8.2f} s  peak RSS {peak_rss:8.1f} MiB  anonymous RSS {anonymous_rss:8.1f} MiB")
+
+        if results["in_memory"][3] != results["streaming"][3]:
+            raise RuntimeError("Streaming and in-memory results differ.")
+
+
+if __name__ == "__main__":
+    main()
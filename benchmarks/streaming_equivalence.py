@@ -0,0 +1,132 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+Checks that streaming.StreamingInference, fed with blocks of irregular sizes, returns the same output
+as NeuralNetwork.forward on the unfolded windows of the whole signal, for several conv1d strides. The
+signal is read from a recording, the test input of the dataset by default, or with --synthesize
+synthesized and decoded from a 16-bit WAV file. Also checks StreamingInference.render and reset.
+Exits with status 1 if the maximum absolute difference of any stride exceeds the tolerance.
+
+Usage:
+    python benchmarks/streaming_equivalence.py
+    python benchmarks/streaming_equivalence.py --audio captures/guitar.wav --seconds 5 --strides 4 12
+    python benchmarks/streaming_equivalence.py --synthesize
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from pedalboard.io import AudioFile
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "source"))
+from model import NeuralNetwork
+from streaming import StreamingInference
+
+DEFAULT_AUDIO = Path(__file__).resolve().parents[1] / "data" / "raw" / "ts9_test1_in_FP32.wav"
+
+
+def read_signal(path, seconds: float) -> torch.Tensor:
+    """Returns the first channel of the first seconds of a WAV file, scaled to a peak of 1."""
+    with AudioFile(str(path)) as f:
+        signal = f.read(min(f.frames, int(seconds * f.samplerate)))[0]
+    return torch.from_numpy(signal / max(np.abs(signal).max(), 1e-9)).float()
+
+
+def decoded_signal(seconds: float, sample_rate: int = 44100) -> torch.Tensor:
+    """Synthesizes decaying plucked tones with noise, writes them to a 16-bit WAV file and reads them back."""
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    signal = 0.01 * rng.standard_normal(len(t))
+    onsets = np.arange(0, seconds, 0.25)
+    for onset, frequency in zip(onsets, rng.uniform(80, 700, size=len(onsets))):
+        tone = np.sin(2 * np.pi * frequency * (t - onset)) * np.exp(-6 * (t - onset))
+        signal += np.where(t >= onset, tone, 0.0)
+    signal = (0.9 * signal / np.abs(signal).max()).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "signal.wav"
+        with AudioFile(str(path), "w", sample_rate, 1, bit_depth=16) as f:
+            f.write(signal[None])
+        return read_signal(path, seconds)
+
+
+def irregular_blocks(length: int, max_block: int, seed: int):
+    """Splits range(length) into blocks of random sizes from 0 to max_block, including single samples."""
+    rng = np.random.default_rng(seed)
+    start = 0
+    while start < length:
+        size = int(rng.choice([0, 1, rng.integers(2, max_block + 1)], p=[0.05, 0.15, 0.8]))
+        yield start, min(start + size, length)
+        start += size
+
+
+def reference(model, signal: torch.Tensor, input_size: int, batch_size: int = 4096) -> torch.Tensor:
+    """forward on the windows ending at every sample, with zeros before the signal like a new stream."""
+    windows = torch.cat((torch.zeros(input_size - 1), signal)).unfold(0, input_size, 1)
+    return torch.cat([model(windows[i:i + batch_size].unsqueeze(1))[:, 0] for i in range(0, len(windows), batch_size)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--audio", default=str(DEFAULT_AUDIO), help="WAV file to process.")
+    parser.add_argument("--synthesize", action="store_true", help="Process a synthesized and decoded signal instead of --audio.")
+    parser.add_argument("--seconds", type=float, default=1.0, help="Length of the processed signal.")
+    parser.add_argument("--conv1d-filters", type=int, default=16)
+    parser.add_argument("--strides", type=int, nargs="+", default=[1, 3, 4, 7, 12], help="conv1d_strides of the compared models.")
+    parser.add_argument("--hidden-units", type=int, default=36)
+    parser.add_argument("--input-size", type=int, default=150)
+    parser.add_argument("--max-block", type=int, default=5000, help="Largest block passed to process.")
+    parser.add_argument("--tolerance", type=float, default=1e-5)
+    args = parser.parse_args()
+
+    if args.synthesize:
+        signal = decoded_signal(args.seconds)
+    elif Path(args.audio).is_file():
+        signal = read_signal(args.audio, args.seconds)
+    else:
+        print(f"{args.audio} not found, pull the dataset with dvc pull or pass a recording with --audio.")
+        sys.exit(1)
+    print(f"{len(signal)} samples from {'a synthesized 16-bit WAV file' if args.synthesize else args.audio}")
+
+    failed = False
+    print(f"{'stride':>6} {'blocks':>7} {'process':>10} {'render':>10} {'reset':>10} {'reference ms':>13} {'streaming ms':>13}")
+    for stride in args.strides:
+        torch.manual_seed(stride)
+        model = NeuralNetwork(args.conv1d_filters, stride, args.hidden_units).eval()
+        with torch.no_grad():
+            start = time.perf_counter()
+            expected = reference(model, signal, args.input_size)
+            reference_ms = 1000 * (time.perf_counter() - start)
+
+        stream = StreamingInference(model, args.input_size)
+        blocks = list(irregular_blocks(len(signal), args.max_block, seed=stride))
+        start = time.perf_counter()
+        streamed = torch.cat([stream.process(signal[low:high]) for low, high in blocks])
+        streaming_ms = 1000 * (time.perf_counter() - start)
+        # A reset stream must start from silence again, render uses fixed blocks that do not divide the signal
+        stream.reset()
+        rendered = stream.render(signal, block_size=4093)
+        stream.reset()
+        restarted = stream.process(signal[:args.max_block])
+
+        errors = [
+            (streamed - expected).abs().max().item(),
+            (rendered - expected).abs().max().item(),
+            (restarted - expected[:len(restarted)]).abs().max().item(),
+        ]
+        failed = failed or max(errors) > args.tolerance or len(streamed) != len(expected)
+        print(f"{stride:>6} {len(blocks):>7} " + " ".join(f"{error:>10.2e}" for error in errors)
+              + f" {reference_ms:>13.1f} {streaming_ms:>13.1f}")
+    if failed:
+        print(f"The streamed outputs differ from forward by more than the tolerance {args.tolerance}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
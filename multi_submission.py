@@ -2,24 +2,77 @@
 # This file is licensed under the Apache License, Version 2.0.
 # See the LICENSE file in the root of this project for details.
 
-import itertools
-import subprocess
-import os 
-
-# Submit experiment for hyperparameter combination
-def submit_batch_job(test_split, batch_size):
-    # Set dynamic parameters for the batch job as environment variables
-    # But dont forget to add the os.environ to the new environment variables otherwise the PATH is not found
-    env = {
-        **os.environ,
-        "EXP_PARAMS": f"-S preprocess.test_split={test_split} -S train.batch_size={batch_size}"
-    }
-    # Run sbatch command with the environment variables as bash! subprocess! command (otherwise module not found)
-    subprocess.run(['/usr/bin/bash', '-c', 'sbatch slurm_job.sh'], env=env)
+"""
+Runs a hyperparameter sweep defined in sweep.yaml.
+
+By default the pending trials are submitted as a single SLURM job array, where every array task runs
+trials_per_task trials concurrently in one allocation. Trials whose parameters already finished in an
+earlier sweep are skipped. With --local the trials run in a process pool on this machine instead.
+With an ASHA scheduler in sweep.yaml, unpromising trials stop early and --report shows the saved compute.
+
+Usage:
+    python multi_submission.py [--config sweep.yaml] [--dry-run]
+    python multi_submission.py --local --workers 2
+    python multi_submission.py --report
+    python multi_submission.py --run-task logs/sweeps/<name>/tasks.json <task_id>  (used by slurm_sweep.sh)
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "source"))
+from utils import asha, config, sweep
+
+
+def print_report(sweep_config):
+    store_dir = sweep.SWEEP_DIR / sweep_config["name"] / "asha"
+    if not sweep_config["scheduler"] or not store_dir.exists():
+        return
+    summary = asha.summarize(store_dir)
+    print(f"ASHA stopped {summary['stopped']} of {summary['trials']} trials early: {summary['epochs']} epochs "
+          f"instead of {summary['full_epochs']} without early stopping, {summary['saved']:.1%} of the compute saved.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default="sweep.yaml", help="The sweep configuration.")
+    parser.add_argument("--params", default="params.yaml", help="The default parameters.")
+    parser.add_argument("--local", action="store_true", help="Run the trials in a local process pool.")
+    parser.add_argument("--workers", type=int, default=None, help="Concurrent local trials. Defaults to trials_per_task.")
+    parser.add_argument("--command", default=None, help="Overrides the command of each trial.")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the pending trials.")
+    parser.add_argument("--report", action="store_true", help="Print the compute saved by early stopping.")
+    parser.add_argument("--run-task", nargs=2, metavar=("TASKS_FILE", "TASK_ID"), help="Run one task of a job array.")
+    args = parser.parse_args()
+
+    if args.run_task:
+        tasks_file, task_id = args.run_task
+        sys.exit(1 if sweep.run_task(tasks_file, int(task_id)) else 0)
+
+    sweep_config = sweep.load_sweep_config(args.config)
+    if args.command is not None:
+        sweep_config["command"] = args.command
+    if args.report:
+        print_report(sweep_config)
+        return
+    trials, skipped = sweep.plan_trials(sweep_config, config.Params(args.params))
+    print(f"Sweep '{sweep_config['name']}': {len(trials)} pending trials, {skipped} already finished.")
+    for trial in trials:
+        print(f"  {sweep.format_exp_params(trial)}")
+    if args.dry_run or not trials:
+        return
+
+    if args.local:
+        env = sweep.scheduler_env(sweep_config)
+        failed = sweep.run_local(trials, sweep_config["command"], args.workers or sweep_config["trials_per_task"], env=env)
+        print(f"{len(trials) - failed} of {len(trials)} trials finished.")
+        print_report(sweep_config)
+        sys.exit(1 if failed else 0)
+    tasks = sweep.pack_trials(trials, sweep_config["trials_per_task"])
+    tasks_file = sweep.submit_array(sweep_config, tasks)
+    print(f"Submitted {len(tasks)} array tasks, see {tasks_file}.")
+
 
 if __name__ == "__main__":
-    test_split_list = [0.2, 0.3]
-    batch_size_list = [2048, 4096]
-    # Iterate over a cartesian product parameter grid of the test_split and batch_size lists
-    for test_split, batch_size in itertools.product(test_split_list, batch_size_list):
-        submit_batch_job(test_split,batch_size)
+    main()
@@ -0,0 +1,45 @@
+#!/bin/bash
+
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+# Description: Batch script of one task of a sweep job array, submitted by multi_submission.py.
+# Runs the trials of the task concurrently within this allocation.
+
+#SBATCH -J tustu-sweep
+#SBATCH --ntasks=1
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-core=1
+#SBATCH --cpus-per-task=2
+#SBATCH --gres=gpu:tesla:1
+#SBATCH --mem=100GB
+#SBATCH --time=10:00:00
+#SBATCH --partition=gpu
+#SBATCH --output=./logs/slurm/slurm-%A_%a.out
+
+# Load necessary modules
+module load singularity/4.0.2
+
+# Set environment variables defined in global.env
+set -o allexport
+source global.env
+set +o allexport
+
+# Define DEFAULT_DIR in the host environment
+export DEFAULT_DIR="$PWD"
+
+# Pull the latest docker image once per sweep: the first array task that finds the image older than
+# the tasks file of the sweep pulls it, the others wait for the lock and reuse it
+IMAGE=$TUSTU_PROJECT_NAME-image_latest.sif
+(
+  flock 9
+  if [ ! -f $IMAGE ] || [ $IMAGE -ot $TUSTU_SWEEP_TASKS ]; then
+    singularity pull --force $IMAGE docker://$TUSTU_DOCKERHUB_USERNAME/$TUSTU_PROJECT_NAME-image:latest
+  fi
+) 9>$IMAGE.lock
+
+echo "Starting singularity execution of array task $SLURM_ARRAY_TASK_ID..."
+
+# Run the trials of this array task in the singularity container
+singularity exec --nv --bind $DEFAULT_DIR $IMAGE python multi_submission.py --run-task $TUSTU_SWEEP_TASKS $SLURM_ARRAY_TASK_ID
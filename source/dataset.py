@@ -0,0 +1,468 @@
+import json
+import numpy as np
+import torch
+from pathlib import Path
+
+# On-disk format of data/processed: raw little-endian float32 shards, one per audio file, plus a JSON manifest
+DTYPE = '<f4'
+FORMAT_VERSION = 2
+MANIFEST_FILE = 'manifest.json'
+LEGACY_FILE = 'data.pt'
+
+class WindowDataset(torch.utils.data.Dataset):
+    """
+    Serves sliding windows of a 1-D input signal together with the target sample
+    aligned to the last element of each window.
+
+    Only the 1-D signals are stored. Windows are strided views into the input signal,
+    so no N x input_size tensor is ever materialized. The signal may consist of several
+    audio files, given as lists with one tensor per file, e.g. the memory-mapped shards of
+    load_processed_data. The files are not concatenated and no window crosses the boundary
+    between two files.
+
+    Args:
+        inputs (torch.Tensor or list): 1-D normalized input signal, or one per file.
+        targets (torch.Tensor or list): 1-D normalized target signal(s) of the same length(s).
+        input_size (int): Number of input samples per window.
+    """
+
+    def __init__(self, inputs, targets, input_size):
+        inputs = [inputs] if torch.is_tensor(inputs) else list(inputs)
+        targets = [targets] if torch.is_tensor(targets) else list(targets)
+        if (not inputs or len(inputs) != len(targets)
+                or any(x.dim() != 1 or x.shape != y.shape for x, y in zip(inputs, targets))):
+            raise ValueError("inputs and targets must be 1-D tensors of the same length, or lists of them.")
+        lengths = [len(x) for x in inputs]
+        if min(lengths) < input_size:
+            raise ValueError(f"Signal of length {min(lengths)} is shorter than input_size={input_size}.")
+        self.inputs = inputs
+        self.targets = targets
+        self.input_size = input_size
+        self.lengths = lengths
+        # (N, input_size) strided views, share memory with self.inputs
+        self.windows = [x.unfold(0, input_size, 1) for x in inputs]
+        # Window indices at which each file starts
+        window_counts = torch.tensor([length - input_size + 1 for length in lengths])
+        self.num_windows = int(window_counts.sum())
+        self.first_windows = torch.cumsum(window_counts, 0) - window_counts
+        self.file_starts = self.first_windows[1:]
+
+    def __len__(self):
+        return self.num_windows
+
+    def locate(self, index):
+        """
+        Maps window indices 0..len(self)-1 to the files and the positions of the windows in them.
+        The file indices are None for a single file.
+        """
+        if len(self.inputs) == 1:
+            return None, index
+        file_index = torch.searchsorted(self.file_starts.to(index.device), index, right=True)
+        return file_index, index - self.first_windows.to(index.device)[file_index]
+
+    def window_starts(self, index):
+        """
+        Maps window indices 0..len(self)-1 to the positions of the windows in the concatenation of the
+        files, skipping the input_size - 1 positions before each file boundary, whose windows would span
+        two files.
+        """
+        if len(self.file_starts) == 0:
+            return index
+        file_index = torch.searchsorted(self.file_starts.to(index.device), index, right=True)
+        return index + (self.input_size - 1) * file_index
+
+    def __getitem__(self, index):
+        """
+        Returns the window(s) and target(s) for an integer index or a sequence of indices.
+        An integer returns a (1, input_size) view, a sequence returns a (B, 1, input_size)
+        batch gathered with one indexing operation per file.
+        """
+        if isinstance(index, int):
+            file_index = int(torch.searchsorted(self.file_starts, torch.tensor(index), right=True))
+            index -= int(self.first_windows[file_index])
+            X = self.windows[file_index][index].unsqueeze(0)
+            y = self.targets[file_index][index + self.input_size - 1].unsqueeze(0)
+            return X, y
+        file_index, index = self.locate(torch.as_tensor(index, dtype=torch.long))
+        X = _gather_rows(self.windows, file_index, index).unsqueeze(1)
+        y = _gather_rows(self.targets, file_index, index + self.input_size - 1).unsqueeze(1)
+        return X, y
+
+def _gather_rows(parts, file_index, index, out=None):
+    """
+    Returns parts[file_index[i]][index[i]] for every i, e.g. the windows of a batch from the unfolded
+    signals of several files. file_index is None if there is a single part.
+    """
+    if file_index is None:
+        return parts[0][index] if out is None else torch.index_select(parts[0], 0, index, out=out)
+    if out is None:
+        out = parts[0].new_empty((len(index),) + parts[0].shape[1:])
+    # One indexing operation per file, for the rows of the batch that fall into it
+    rows_per_file = torch.split(torch.argsort(file_index), torch.bincount(file_index, minlength=len(parts)).tolist())
+    for part, rows in zip(parts, rows_per_file):
+        if len(rows) > 0:
+            out[rows] = part[index[rows]]
+    return out
+
+def _concatenate(parts, device):
+    # Copies the files into one signal on the device, without a concatenated copy on the host
+    if len(parts) == 1:
+        return parts[0].to(device)
+    signal = torch.empty(sum(len(part) for part in parts), dtype=parts[0].dtype, device=device)
+    offset = 0
+    for part in parts:
+        signal[offset:offset + len(part)].copy_(part)
+        offset += len(part)
+    return signal
+
+def create_dataloader(dataset, batch_size, shuffle, num_workers=0):
+    """
+    Creates a DataLoader that fetches whole batches from a WindowDataset with one strided
+    gather instead of collating batch_size single windows. num_workers is e.g. the
+    dataloader_workers of config.setup_cpu_runtime.
+    """
+    if shuffle:
+        sampler = torch.utils.data.RandomSampler(dataset)
+    else:
+        sampler = torch.utils.data.SequentialSampler(dataset)
+    batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size=batch_size, drop_last=False)
+    # batch_size=None disables automatic batching, each sampled index list is passed to __getitem__
+    return torch.utils.data.DataLoader(dataset, sampler=batch_sampler, batch_size=None, num_workers=num_workers)
+
+def shard_order(length, shuffle, device, rank=0, world_size=1, seed=0, epoch=0):
+    """
+    Returns the order in which this process visits the indices 0..length-1 in an epoch.
+
+    Without distribution this is a permutation from the global RNG, or the identity if shuffle is False.
+    In distributed training all ranks draw the same permutation from a generator seeded with seed + epoch
+    and each takes every world_size-th index, truncated so that all ranks get the same number of indices.
+    """
+    if world_size == 1:
+        if shuffle:
+            return torch.randperm(length, device=device)
+        return torch.arange(length, device=device)
+    if shuffle:
+        generator = torch.Generator(device=device)
+        generator.manual_seed(seed + epoch)
+        order = torch.randperm(length, device=device, generator=generator)
+    else:
+        order = torch.arange(length, device=device)
+    return order[rank:length // world_size * world_size:world_size]
+
+class WindowBatcher:
+    """
+    Iterates over shuffled or ordered batches of a WindowDataset, replacing the DataLoader in train.py.
+
+    The signals are moved to the device once and each batch is produced by a vectorized gather from a
+    per-epoch index permutation. On the CPU the signals of the files stay as they are, e.g. memory-mapped,
+    and a batch is gathered with one indexing operation per file. On other devices the files are copied
+    into one signal and windows that would cross the boundary between two files are skipped, so each
+    batch is a single gather. If the signals do not fit on a CUDA device, they stay on the host and
+    batches are gathered into two pinned buffers that alternate while the previous batch is copied to
+    the device on a side stream. The device_resident setting has no effect on CPU.
+
+    Args:
+        dataset (WindowDataset): The dataset to draw windows from.
+        batch_size (int): Number of windows per batch. The last batch may be smaller.
+        shuffle (bool): Draws a new random permutation per epoch if True, iterates in order otherwise.
+        device (torch.device): The device the batches are returned on.
+        device_resident (bool, optional): Whether to keep the signals on the device. Defaults to None,
+            in which case this is decided from the free device memory.
+        rank (int): Rank of this process in distributed training, which iterates over its shard only.
+        world_size (int): Number of processes in distributed training.
+        seed (int): Seed of the permutation shared by all ranks in distributed training.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle, device, device_resident=None, rank=0, world_size=1, seed=0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = torch.device(device)
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = len(dataset) // world_size if world_size > 1 else len(dataset)
+        if device_resident is None:
+            device_resident = self._fits_on_device()
+        self.device_resident = device_resident or self.device.type == 'cpu'
+        storage_device = self.device if self.device_resident else torch.device('cpu')
+        self.concatenated = storage_device.type != 'cpu'
+        if self.concatenated:
+            self.inputs = [_concatenate(dataset.inputs, storage_device)]
+            self.targets = [_concatenate(dataset.targets, storage_device)]
+        else:
+            self.inputs = dataset.inputs
+            self.targets = dataset.targets
+        self.windows = [part.unfold(0, dataset.input_size, 1) for part in self.inputs]
+        self.target_offset = dataset.input_size - 1
+
+    def _fits_on_device(self):
+        if self.device.type != 'cuda':
+            return True
+        free_memory, _ = torch.cuda.mem_get_info(self.device)
+        data_size = sum(part.nbytes for part in self.dataset.inputs + self.dataset.targets)
+        # Leave room for the model, activations and batches
+        return data_size < free_memory // 2
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        self.epoch += 1
+        if not self.shuffle and self.world_size == 1 and len(self.dataset.lengths) == 1:
+            # Consecutive windows are plain views, no gather needed
+            for start in range(0, len(self.dataset), self.batch_size):
+                stop = min(start + self.batch_size, len(self.dataset))
+                X = self.windows[0][start:stop].unsqueeze(1)
+                y = self.targets[0][start + self.target_offset:stop + self.target_offset].unsqueeze(1)
+                yield X.to(self.device), y.to(self.device)
+            return
+        permutation = shard_order(len(self.dataset), self.shuffle, self.inputs[0].device,
+                                  self.rank, self.world_size, self.seed, self.epoch)
+        if not self.device_resident and self.device.type == 'cuda':
+            yield from self._prefetch(permutation)
+            return
+        for start in range(0, len(permutation), self.batch_size):
+            X, y = self._gather(permutation[start:start + self.batch_size])
+            yield X.to(self.device), y.to(self.device)
+
+    def _locate(self, indices):
+        if self.concatenated:
+            return None, self.dataset.window_starts(indices)
+        return self.dataset.locate(indices)
+
+    def _gather(self, indices):
+        file_index, indices = self._locate(indices)
+        X = _gather_rows(self.windows, file_index, indices).unsqueeze(1)
+        y = _gather_rows(self.targets, file_index, indices + self.target_offset).unsqueeze(1)
+        return X, y
+
+    def _prefetch(self, permutation):
+        copy_stream = torch.cuda.Stream(self.device)
+        buffers = [(torch.empty((self.batch_size, 1, self.dataset.input_size), pin_memory=True),
+                    torch.empty((self.batch_size, 1), pin_memory=True)) for _ in range(2)]
+        copy_done = [None, None]
+
+        def load(batch):
+            slot = batch % 2
+            file_index, indices = self._locate(permutation[batch * self.batch_size:(batch + 1) * self.batch_size])
+            X_host, y_host = buffers[slot]
+            n = len(indices)
+            # The buffer is reused only after its previous copy to the device has finished
+            if copy_done[slot] is not None:
+                copy_done[slot].synchronize()
+            _gather_rows(self.windows, file_index, indices, out=X_host[:n, 0])
+            _gather_rows(self.targets, file_index, indices + self.target_offset, out=y_host[:n, 0])
+            with torch.cuda.stream(copy_stream):
+                X = X_host[:n].to(self.device, non_blocking=True)
+                y = y_host[:n].to(self.device, non_blocking=True)
+                copy_done[slot] = torch.cuda.Event()
+                copy_done[slot].record(copy_stream)
+            return X, y, copy_done[slot]
+
+        next_batch = load(0)
+        for batch in range(len(self)):
+            X, y, event = next_batch
+            if batch + 1 < len(self):
+                next_batch = load(batch + 1)
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_event(event)
+            X.record_stream(compute_stream)
+            y.record_stream(compute_stream)
+            yield X, y
+
+class SegmentBatcher:
+    """
+    Iterates over batches of contiguous segments of a WindowDataset for the segment training mode,
+    in which NeuralNetwork.forward_windows predicts segment_length targets per segment at once.
+
+    The windows of each file are split into consecutive segments of segment_length windows, the last
+    one aligned to the end of the file so that every window is covered in each epoch. Unless the number
+    of windows is a multiple of segment_length, the last segment overlaps the one before it, and the
+    windows in the overlap are trained twice per epoch. Each batch holds the inputs of segments_per_batch segments, shape (B, 1, segment_length + input_size - 1), and their targets,
+    shape (B, segment_length). Like WindowBatcher, the signals are moved to the device once, where the
+    files are copied into one signal, and stay separate on the CPU.
+
+    Args:
+        dataset (WindowDataset): The dataset to draw segments from.
+        segment_length (int): Number of windows (targets) per segment.
+        segments_per_batch (int): Number of segments per batch.
+        shuffle (bool): Shuffles the segment order per epoch if True.
+        device (torch.device): The device the signals and batches are stored on.
+        rank (int): Rank of this process in distributed training, which iterates over its shard only.
+        world_size (int): Number of processes in distributed training.
+        seed (int): Seed of the permutation shared by all ranks in distributed training.
+    """
+
+    def __init__(self, dataset, segment_length, segments_per_batch, shuffle, device, rank=0, world_size=1, seed=0):
+        self.dataset = dataset
+        # Segments never cross the boundary between two files, and all segments of a batch have the same
+        # length, so they are at most as long as the shortest file
+        self.segment_length = min(segment_length, min(dataset.lengths) - dataset.input_size + 1)
+        if self.segment_length < segment_length:
+            short_files = [i for i, length in enumerate(dataset.lengths) if length - dataset.input_size + 1 < segment_length]
+            print(f"Warning: files {short_files} of the dataset have fewer than segment_length={segment_length} windows, "
+                  f"so the segments of all files are shortened to {self.segment_length} windows. "
+                  "Leave out the short files or lower train.segment_length to keep the throughput of the segment mode.")
+        self.segments_per_batch = segments_per_batch
+        # Number of targets per full batch, used for progress reporting
+        self.batch_size = self.segment_length * segments_per_batch
+        self.shuffle = shuffle
+        self.device = torch.device(device)
+        concatenated = self.device.type != 'cpu'
+        if concatenated:
+            self.inputs = [_concatenate(dataset.inputs, self.device)]
+            self.targets = [_concatenate(dataset.targets, self.device)]
+        else:
+            self.inputs = dataset.inputs
+            self.targets = dataset.targets
+        self.input_segments = [part.unfold(0, self.segment_length + dataset.input_size - 1, 1) for part in self.inputs]
+        self.target_segments = [part[dataset.input_size - 1:].unfold(0, self.segment_length, 1) for part in self.targets]
+        starts = []
+        files = []
+        offset = 0
+        for file_index, length in enumerate(dataset.lengths):
+            last = length - dataset.input_size + 1 - self.segment_length
+            file_starts = torch.arange(0, last + 1, self.segment_length)
+            if file_starts[-1] != last:
+                file_starts = torch.cat((file_starts, torch.tensor([last])))
+            starts.append(file_starts + offset)
+            files.append(torch.full_like(file_starts, file_index))
+            if concatenated:
+                offset += length
+        self.starts = torch.cat(starts).to(self.device)
+        # The file of each segment, None if there is only one signal
+        self.files = torch.cat(files).to(self.device) if len(self.inputs) > 1 else None
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.num_segments = len(self.starts) // world_size if world_size > 1 else len(self.starts)
+        # Number of targets per epoch on this rank, used for progress reporting
+        self.num_samples = self.num_segments * self.segment_length
+
+    def __len__(self):
+        return (self.num_segments + self.segments_per_batch - 1) // self.segments_per_batch
+
+    def __iter__(self):
+        self.epoch += 1
+        order = shard_order(len(self.starts), self.shuffle, self.device, self.rank, self.world_size, self.seed, self.epoch)
+        starts = self.starts[order]
+        files = self.files[order] if self.files is not None else None
+        for i in range(0, len(starts), self.segments_per_batch):
+            batch_starts = starts[i:i + self.segments_per_batch]
+            batch_files = files[i:i + self.segments_per_batch] if files is not None else None
+            X = _gather_rows(self.input_segments, batch_files, batch_starts).unsqueeze(1)
+            y = _gather_rows(self.target_segments, batch_files, batch_starts)
+            yield X, y
+
+def write_manifest(directory, shards, input_size, peaks, params_hash):
+    """
+    Writes the manifest, the index of the shards in directory. The manifest is written last
+    and atomically, so its presence marks a complete dataset.
+
+    Args:
+        directory (Path): Directory containing the shard files.
+        shards (list): One dict per audio file pair with the 'input' and 'target' np.memmap written to
+            directory, the 'sources' (the paths of the audio files) and the 'split_index', the index of
+            the first testing sample of the file (its length if the whole file is used for training).
+        input_size (int): Number of input samples per window.
+        peaks (dict): Maps array names ('input', 'target') to the peak used for normalization.
+        params_hash (str): Hash of the parameters that produced the data.
+    """
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'dtype': DTYPE,
+        'shards': [{
+            'arrays': {name: {'file': Path(shard[name].filename).name, 'shape': list(shard[name].shape)}
+                       for name in ('input', 'target')},
+            'sources': {name: str(path) for name, path in shard['sources'].items()},
+            'split_index': shard['split_index'],
+        } for shard in shards],
+        'input_size': input_size,
+        'peak': {name: float(peak) for name, peak in peaks.items()},
+        'params_hash': params_hash
+    }
+    save_manifest(directory, manifest)
+
+def save_manifest(directory, manifest):
+    """
+    Writes a manifest dict to directory. The file is replaced atomically, so a manifest that is a hardlink
+    into the dataset cache is never modified in place.
+    """
+    directory = Path(directory)
+    tmp_path = directory / (MANIFEST_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    tmp_path.replace(directory / MANIFEST_FILE)
+
+def _open_array(path, dtype, shape):
+    # Copy-on-write mapping: pages stay shared in the page cache between processes until written
+    array = np.memmap(path, dtype=dtype, mode='c', shape=tuple(shape))
+    if not array.dtype.isnative:
+        array = array.astype(array.dtype.newbyteorder('='))
+    return torch.from_numpy(array)
+
+def _load_legacy(file_path):
+    data = torch.load(file_path)
+    if 'X_training' in data:
+        return data
+    # Materialized windows of the original format: (N, 1, input_size) inputs, (N, 1) targets
+    input_size = data['X_ordered_training'].shape[-1]
+    converted = {'input_size': input_size}
+    for split in ['training', 'testing']:
+        windows = data[f'X_ordered_{split}'][:, 0, :]
+        converted[f'X_{split}'] = torch.cat((windows[:, 0], windows[-1, 1:]))
+        # Targets before the first full window are never used
+        converted[f'y_{split}'] = torch.cat((torch.zeros(input_size - 1), data[f'y_ordered_{split}'][:, 0]))
+    return converted
+
+def load_processed_data(directory):
+    """
+    Opens the preprocessed data in directory. Raw shards described by a manifest are memory-mapped,
+    the pickled data.pt of older versions is loaded into memory. The training and testing parts of the
+    shards stay separate memory-mapped tensors, which WindowDataset takes as a list of files.
+
+    Args:
+        directory (Path): The data/processed directory.
+
+    Returns:
+        dict: Lists 'X_training', 'y_training', 'X_testing', 'y_testing' of 1-D tensors, one per file
+            with samples in the split, 'input_size' and the 'manifest' dict if one exists.
+    """
+    directory = Path(directory)
+    manifest_path = directory / MANIFEST_FILE
+    if not manifest_path.exists():
+        legacy_path = directory / LEGACY_FILE
+        if not legacy_path.exists():
+            raise FileNotFoundError(f"No preprocessed data found in {directory}.")
+        print(f"Loading legacy preprocessed data from {legacy_path}.")
+        data = _load_legacy(legacy_path)
+        for key in ('X_training', 'y_training', 'X_testing', 'y_testing'):
+            data[key] = [data[key]]
+        return data
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest['format_version'] == 1:
+        # A single pair of arrays
+        shards = [{'arrays': manifest['arrays'], 'split_index': manifest['split_index']}]
+    elif manifest['format_version'] == FORMAT_VERSION:
+        shards = manifest['shards']
+    else:
+        raise ValueError(f"Unsupported processed data format version {manifest['format_version']}.")
+    parts = {key: [] for key in ('X_training', 'y_training', 'X_testing', 'y_testing')}
+    for shard in shards:
+        arrays = {name: _open_array(directory / entry['file'], manifest['dtype'], entry['shape'])
+                  for name, entry in shard['arrays'].items()}
+        split_idx = shard['split_index']
+        parts['X_training'].append(arrays['input'][:split_idx])
+        parts['y_training'].append(arrays['target'][:split_idx])
+        parts['X_testing'].append(arrays['input'][split_idx:])
+        parts['y_testing'].append(arrays['target'][split_idx:])
+    # Files without samples in a split, e.g. the held-out files in the training split, are left out
+    data = {key: [part for part in tensors if len(part) > 0] for key, tensors in parts.items()}
+    data['input_size'] = manifest['input_size']
+    data['manifest'] = manifest
+    return data
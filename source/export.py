@@ -1,8 +1,105 @@
+import inspect
+import json
+import statistics
+import time
+import numpy as np
 import torch
 from utils import config
-from model import NeuralNetwork
+from model import NeuralNetwork, InferenceNetwork
+from dataset import WindowDataset, load_processed_data
 from pathlib import Path
 
+def export_onnx(model, input_size, output_file_path):
+    # Export with a dynamic batch dimension, so that the runtime can process any number of windows at once
+    example = torch.rand(1, 1, input_size)
+    output_file_path = Path(output_file_path)
+    output_file_path.parent.mkdir(parents=True, exist_ok=True)
+    # PyTorch versions newer than the pinned one default to the dynamo exporter, whose graph keeps a fixed
+    # batch size in the inferred shapes, which breaks the quantization. Use the TorchScript exporter in all versions
+    exporter = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(model, example, output_file_path, export_params=True, opset_version=17, do_constant_folding=True,
+                      input_names=['input'], output_names=['output'],
+                      dynamic_axes={'input': {0: 'batch_size'}, 'output': {0: 'batch_size'}}, **exporter)
+
+def sample_windows(signals, input_size, count, seed=None):
+    """
+    Returns count windows of input_size samples of the 1-D signals of a split (one per file) as a
+    (count, 1, input_size) float32 array, evenly spaced over the windows of all files, or drawn at
+    random if a seed is given. No window spans two files.
+    """
+    dataset = WindowDataset(signals, signals, input_size)
+    count = min(count, len(dataset))
+    if seed is None:
+        starts = np.linspace(0, len(dataset) - 1, count).astype(np.int64)
+    else:
+        starts = np.random.default_rng(seed).choice(len(dataset), size=count, replace=False)
+    windows, _ = dataset[starts]
+    return windows.numpy().astype(np.float32)
+
+class WindowCalibrationReader:
+    """
+    Feeds windows of the training split to the static quantization of ONNX Runtime in batches,
+    implementing the get_next interface of onnxruntime.quantization.CalibrationDataReader.
+    """
+
+    def __init__(self, windows, batch_size=256):
+        self.batches = [windows[i:i + batch_size] for i in range(0, len(windows), batch_size)]
+        self.position = 0
+
+    def get_next(self):
+        if self.position == len(self.batches):
+            return None
+        self.position += 1
+        return {'input': self.batches[self.position - 1]}
+
+    def rewind(self):
+        self.position = 0
+
+def quantize_variants(model_path, calibration_windows):
+    """
+    Writes the int8 variants next to the FP32 model: model.int8-dynamic.onnx with weights quantized
+    ahead of time and activations quantized at runtime, and model.int8-static.onnx with activations
+    quantized with ranges calibrated on calibration_windows. Returns the paths by variant name.
+    """
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    model_path = Path(model_path)
+    paths = {
+        'int8-dynamic': model_path.with_name(f'{model_path.stem}.int8-dynamic.onnx'),
+        'int8-static': model_path.with_name(f'{model_path.stem}.int8-static.onnx'),
+    }
+    quantize_dynamic(model_path, paths['int8-dynamic'], weight_type=QuantType.QInt8)
+    quantize_static(model_path, paths['int8-static'], WindowCalibrationReader(calibration_windows),
+                    quant_format=QuantFormat.QDQ, activation_type=QuantType.QInt8, weight_type=QuantType.QInt8)
+    return paths
+
+def create_session(model_path):
+    import onnxruntime
+
+    return onnxruntime.InferenceSession(str(model_path), providers=['CPUExecutionProvider'])
+
+def verify(session, reference, windows, batch_size=4096):
+    """Returns the maximum absolute and the RMS error of the session's outputs compared to the reference outputs."""
+    outputs = np.concatenate([session.run(None, {'input': windows[i:i + batch_size]})[0]
+                              for i in range(0, len(windows), batch_size)])
+    errors = np.abs(outputs.reshape(-1) - reference.reshape(-1))
+    return float(errors.max()), float(np.sqrt(np.mean(errors ** 2)))
+
+def measure_latency(session, input_size, batch_sizes, repeats):
+    """Returns the median latency in ms and the throughput in windows/s of the session per batch size."""
+    results = {}
+    for batch_size in batch_sizes:
+        inputs = np.random.default_rng(0).uniform(-1, 1, size=(batch_size, 1, input_size)).astype(np.float32)
+        session.run(None, {'input': inputs})
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            session.run(None, {'input': inputs})
+            times.append(time.perf_counter() - start)
+        median = statistics.median(times)
+        results[f'b{batch_size}'] = {'latency_ms': round(1000 * median, 4), 'samples_per_second': round(batch_size / median, 1)}
+    return results
+
 def main():
     # Load the hyperparameters from the params yaml file into a Dictionary
     params = config.Params()
@@ -12,6 +109,11 @@ def main():
     conv1d_strides = params['model']['conv1d_strides']
     conv1d_filters = params['model']['conv1d_filters']
     hidden_units = params['model']['hidden_units']
+    quantize = params['export']['quantize']
+    tolerance = params['export']['tolerance']
+    batch_sizes = params['export']['batch_sizes']
+    calibration_windows = params['export']['calibration_windows']
+    verification_windows = params['export']['verification_windows']
 
     # Define the model (ensure to use the same architecture as in train.py)
     model = NeuralNetwork(conv1d_filters, conv1d_strides, hidden_units)
@@ -19,15 +121,50 @@ def main():
     # Load the model state
     input_file_path = Path('models/checkpoints/model.pth')
     model.load_state_dict(torch.load(input_file_path, map_location=torch.device('cpu')))
+    model.eval()
 
-    # Export the model
-    example = torch.rand(1, 1, input_size)
-    output_file_path = Path('models/exports/model.onnx') 
-    output_file_path.parent.mkdir(parents=True, exist_ok=True)
-    torch.onnx.export(model, example, output_file_path, export_params=True, opset_version=17, do_constant_folding=True,
-                      input_names=['input'], output_names=['output'],
-                      dynamic_axes={'input': {0: 'batch_size'}, 'output': {0: 'batch_size'}})
+    # Export the inference version of the model, whose convolutions are matrix products without padded copies
+    output_file_path = Path('models/exports/model.onnx')
+    export_onnx(InferenceNetwork(model, input_size), input_size, output_file_path)
     print("Model exported to ONNX format.")
+    variants = {'fp32': output_file_path}
+
+    # Quantize with ranges calibrated on the training split, so the test split stays unseen
+    data = load_processed_data(Path('data/processed'))
+    if quantize:
+        calibration = sample_windows(data['X_training'], input_size, calibration_windows, seed=params['general']['random_seed'])
+        variants.update(quantize_variants(output_file_path, calibration))
+        print("Quantized int8 variants exported.")
+
+    # Check every variant against the PyTorch model on the test split and measure its latency with ONNX Runtime
+    windows = sample_windows(data['X_testing'], input_size, verification_windows)
+    with torch.no_grad():
+        reference = torch.cat([model(torch.from_numpy(windows[i:i + 4096])) for i in range(0, len(windows), 4096)]).numpy()
+    metrics = {'tolerance': tolerance, 'variants': {}}
+    for name, path in variants.items():
+        session = create_session(path)
+        max_error, rms_error = verify(session, reference, windows)
+        metrics['variants'][name] = {
+            'file_size_kb': round(path.stat().st_size / 1024, 1),
+            'max_abs_error': max_error,
+            'rms_error': rms_error,
+            'within_tolerance': max_error <= tolerance,
+            'latency': measure_latency(session, input_size, batch_sizes, repeats=20),
+        }
+        print(f"{name}: max error {max_error:.2e}, RMS error {rms_error:.2e}, "
+              f"{metrics['variants'][name]['latency'][f'b{batch_sizes[0]}']['latency_ms']:.3f} ms at batch size {batch_sizes[0]}"
+              f"{'' if max_error <= tolerance else ', exceeds the tolerance'}")
+
+    # The recommended variant for real-time use is the fastest at the smallest batch size within the tolerance, then the smallest
+    candidates = [name for name, result in metrics['variants'].items() if result['within_tolerance']]
+    smallest_batch = f'b{min(batch_sizes)}'
+    metrics['recommended'] = min(candidates, key=lambda name: (metrics['variants'][name]['latency'][smallest_batch]['latency_ms'],
+                                                             metrics['variants'][name]['file_size_kb'])) if candidates else None
+    print(f"Recommended variant: {metrics['recommended']}")
+    metrics_file_path = Path('metrics/export.json')
+    metrics_file_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(metrics_file_path, 'w') as f:
+        json.dump(metrics, f, indent=2)
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,7 @@
+import copy
+import torch
 from torch import nn
+import torch.nn.functional as F
 
 class NeuralNetwork(nn.Module):
     def __init__(self, conv1d_filters, conv1d_strides, hidden_units):
@@ -18,3 +21,252 @@ class NeuralNetwork(nn.Module):
         output, (hidden, cell) = self.lstm(x)
         x = self.linear(output[:, -1, :])
         return x
+
+    def padding_steps(self):
+        # Number of leading conv2 frames that only cover the zero padding of the conv1 output
+        kernel_size, stride = self.conv2.kernel_size[0], self.conv2.stride[0]
+        return max(0, (self.pad.padding[0] - kernel_size) // stride + 1)
+
+    def padding_state(self):
+        """
+        Returns the LSTM state (hidden, cell) after the leading steps whose conv2 frame only covers
+        padding. These steps are identical for every window, their input is the conv2 bias.
+        """
+        steps = self.padding_steps()
+        x = self.conv2.bias.view(1, 1, -1).expand(1, steps, -1)
+        _, state = self.lstm(x)
+        return state
+
+    def forward_windows(self, x, window_size, padding_state=None):
+        """
+        Applies forward to every window of window_size consecutive samples of x, i.e. it predicts
+        one output per window for all length - window_size + 1 windows at once.
+
+        Instead of convolving every window, both convolutions run over x once: each conv1 frame of a
+        window is read from a stride 1 convolution over x with the kernel taps that fall onto real
+        samples, and each conv2 frame is a dilated convolution over these series. The LSTM starts from
+        padding_state instead of running the steps that only see padding. The result equals forward on
+        the unfolded windows up to floating point rounding.
+
+        Args:
+            x (torch.Tensor): Input of shape (batch, 1, length).
+            window_size (int): Number of samples per window (general.input_size).
+            padding_state (tuple, optional): Result of padding_state(), computed if None.
+
+        Returns:
+            torch.Tensor: Predictions of shape (batch, length - window_size + 1).
+        """
+        batch_size, _, length = x.shape
+        num_windows = length - window_size + 1
+        pad = self.pad.padding[0]
+
+        # conv1 frames of a padded window as (taps, offset): the frame of window n is the convolution
+        # of x with the kernel taps (low, high) at position n + offset, or the bias if no tap is real
+        kernel_size, stride = self.conv1.kernel_size[0], self.conv1.stride[0]
+        num_frames = (window_size + 2 * pad - kernel_size) // stride + 1
+        frames = []
+        for frame in range(num_frames):
+            start = stride * frame
+            low, high = max(0, pad - start), min(kernel_size, pad + window_size - start)
+            frames.append(((low, high), start - pad + low) if high > low else None)
+        series = {}
+        for taps, _ in filter(None, frames):
+            if taps not in series:
+                series[taps] = F.conv1d(x, self.conv1.weight[:, :, taps[0]:taps[1]], self.conv1.bias)
+
+        # conv2 frames after the padding-only steps, grouped by the series their taps read from
+        kernel_size2, stride2 = self.conv2.kernel_size[0], self.conv2.stride[0]
+        num_frames2 = (num_frames + 2 * pad - kernel_size2) // stride2 + 1
+        steps = self.padding_steps()
+        outputs = []
+        for frame2 in range(steps, num_frames2):
+            constant = self.conv2.bias.clone()
+            groups = {}
+            for tap in range(kernel_size2):
+                frame = stride2 * frame2 + tap - pad
+                if not 0 <= frame < num_frames:
+                    continue
+                if frames[frame] is None:
+                    constant = constant + self.conv2.weight[:, :, tap] @ self.conv1.bias
+                else:
+                    taps, offset = frames[frame]
+                    groups.setdefault(taps, []).append((tap, offset))
+            y = constant.view(1, -1, 1)
+            for taps, members in groups.items():
+                # Consecutive conv2 taps on consecutive conv1 frames form one dilated convolution
+                first_tap, first_offset = members[0]
+                dilation = members[1][1] - first_offset if len(members) > 1 else 1
+                if all(member == (first_tap + i, first_offset + i * dilation) for i, member in enumerate(members)):
+                    weight = self.conv2.weight[:, :, first_tap:first_tap + len(members)]
+                    y = y + F.conv1d(series[taps][:, :, first_offset:], weight, dilation=dilation)[:, :, :num_windows]
+                else:
+                    for tap, offset in members:
+                        y = y + F.conv1d(series[taps][:, :, offset:offset + num_windows], self.conv2.weight[:, :, tap:tap + 1])
+            outputs.append(y.expand(batch_size, -1, num_windows))
+        x = torch.stack(outputs, dim=-1)
+        x = x.permute(0, 2, 3, 1).reshape(batch_size * num_windows, len(outputs), -1)
+
+        if steps > 0:
+            hidden, cell = padding_state if padding_state is not None else self.padding_state()
+            state = (hidden.expand(-1, len(x), -1).contiguous(), cell.expand(-1, len(x), -1).contiguous())
+        else:
+            state = None
+        output, (hidden, cell) = self.lstm(x, state)
+        x = self.linear(output[:, -1, :])
+        return x.view(batch_size, num_windows)
+
+class WindowsForward(nn.Module):
+    """
+    Wraps a NeuralNetwork so that calling it runs forward_windows, e.g. for the segment training mode
+    under DistributedDataParallel, which only synchronizes gradients of calls to the wrapped module.
+    """
+
+    def __init__(self, model, window_size):
+        super().__init__()
+        self.model = model
+        self.window_size = window_size
+
+    def forward(self, x):
+        return self.model.forward_windows(x, self.window_size)
+
+class PatchConv(nn.Module):
+    """
+    A zero padded Conv1d whose stride equals its kernel size, i.e. the kernel is applied to
+    non-overlapping patches, as matrix products on channels-last input (batch, length, channels).
+
+    The layout of the input is fixed: only the rows in the range real are passed in, the other rows
+    (e.g. outputs of a previous layer that only saw padding) and the padding are constants. The
+    patches within the real rows are one reshape and one matmul with the flattened kernel. The
+    patches that overlap constant rows use the kernel taps on real rows, with the contribution of
+    the constant rows folded into their bias. The patches that only cover constant rows are not
+    computed, they are returned as output_constants next to the range output_real of computed rows,
+    the layout of the input of the next layer. Other strides use the generic padded convolution.
+
+    Args:
+        conv (nn.Conv1d): The trained convolution.
+        pad (int): Number of zeros padded on both sides of the input.
+        constants (torch.Tensor): Values of the input rows outside of real, shape (length, in_channels).
+        real (tuple): The range (start, stop) of the rows that are passed in.
+    """
+
+    def __init__(self, conv, pad, constants, real):
+        super().__init__()
+        kernel_size, stride = conv.kernel_size[0], conv.stride[0]
+        weight, bias = conv.weight.detach(), conv.bias.detach()
+        length = len(constants)
+        num_frames = (length + 2 * pad - kernel_size) // stride + 1
+        self.real = real
+        self.in_channels = constants.shape[1]
+        self.fast = stride == kernel_size
+        self.segments = []
+        if not self.fast:
+            self.pad, self.stride = pad, stride
+            self.register_buffer('weight', weight.clone())
+            self.register_buffer('bias', bias.clone())
+            self.register_buffer('head', constants[:real[0]].clone())
+            self.register_buffer('tail', constants[real[1]:].clone())
+            self.constant_rows = length - (real[1] - real[0])
+            self.output_constants = torch.zeros(num_frames, len(weight))
+            self.output_real = (0, num_frames)
+            return
+
+        # (out_channels, taps, in_channels), so a patch of channels-last input flattens in the same order
+        weight = weight.permute(0, 2, 1)
+        self.register_buffer('weight', weight.reshape(len(weight), -1).t().contiguous())
+        self.register_buffer('bias', bias.clone())
+        padded = F.pad(constants.t(), (pad, pad)).t()
+        # Segments of consecutive computed patches: ('full', first row, patches) or ('partial', first row, last row + 1, index)
+        output_constants, computed = [], []
+        for frame in range(num_frames):
+            start = frame * stride - pad
+            low, high = max(start, real[0]), min(start + kernel_size, real[1])
+            constant_taps = torch.ones(kernel_size, dtype=torch.bool)
+            if high > low:
+                constant_taps[low - start:high - start] = False
+            window = padded[start + pad:start + pad + kernel_size]
+            output_constants.append(bias + torch.einsum('okc,kc->o', weight[:, constant_taps], window[constant_taps]))
+            if high <= low:
+                continue
+            computed.append(frame)
+            previous = self.segments[-1] if self.segments else None
+            if high - low == kernel_size and previous is not None and previous[0] == 'full':
+                self.segments[-1] = ('full', previous[1], previous[2] + 1)
+            elif high - low == kernel_size:
+                self.segments.append(('full', low - real[0], 1))
+            else:
+                index = len(self.segments)
+                taps = weight[:, low - start:high - start]
+                self.register_buffer(f'weight{index}', taps.reshape(len(taps), -1).t().contiguous())
+                self.register_buffer(f'bias{index}', output_constants[-1].clone())
+                self.segments.append(('partial', low - real[0], high - real[0], index))
+        self.kernel_size = kernel_size
+        self.output_constants = torch.stack(output_constants)
+        self.output_real = (computed[0], computed[-1] + 1)
+
+    def forward(self, x):
+        if not self.fast:
+            if self.constant_rows > 0:
+                batch_size = x.shape[0]
+                x = torch.cat((self.head.expand(batch_size, -1, -1), x, self.tail.expand(batch_size, -1, -1)), dim=1)
+            x = F.conv1d(F.pad(x.transpose(1, 2), (self.pad, self.pad)), self.weight, self.bias, stride=self.stride)
+            return x.transpose(1, 2)
+        # The shapes are constants, so the exported graph does not compute them from the input
+        outputs = []
+        for segment in self.segments:
+            if segment[0] == 'full':
+                _, low, patches = segment
+                patch = x[:, low:low + patches * self.kernel_size].reshape(-1, patches, self.kernel_size * self.in_channels)
+                outputs.append(torch.matmul(patch, self.weight) + self.bias)
+            else:
+                _, low, high, index = segment
+                patch = x[:, low:high].reshape(-1, 1, (high - low) * self.in_channels)
+                outputs.append(torch.matmul(patch, getattr(self, f'weight{index}')) + getattr(self, f'bias{index}'))
+        return torch.cat(outputs, dim=1) if len(outputs) > 1 else outputs[0]
+
+class InferenceNetwork(nn.Module):
+    """
+    Inference-only version of a trained NeuralNetwork for windows of a fixed size, with the same
+    input (batch, 1, window_size) and output (batch, 1) as its forward.
+
+    Both convolutions run as PatchConv on channels-last activations, so neither the padded copies
+    nor the permute before the LSTM are needed. The frames that only depend on padding are computed
+    once: the leading ones are folded into the initial LSTM state, like padding_state, the trailing
+    ones are stored. The weights are copied, later changes to the model do not affect it. The module
+    can be traced with torch.jit.trace and exported to ONNX with a dynamic batch dimension.
+
+    Args:
+        model (NeuralNetwork): The trained model.
+        window_size (int): Number of samples per window (general.input_size).
+    """
+
+    def __init__(self, model, window_size):
+        super().__init__()
+        pad = model.pad.padding[0]
+        self.window_size = window_size
+        with torch.no_grad():
+            self.conv1 = PatchConv(model.conv1, pad, torch.zeros(window_size, 1), (0, window_size))
+            self.conv2 = PatchConv(model.conv2, pad, self.conv1.output_constants, self.conv1.output_real)
+            self.lstm = copy.deepcopy(model.lstm)
+            self.linear = copy.deepcopy(model.linear)
+            start, stop = self.conv2.output_real
+            constants = self.conv2.output_constants.unsqueeze(0)
+            if start > 0:
+                _, (hidden, cell) = self.lstm(constants[:, :start])
+            else:
+                hidden = cell = torch.zeros(1, 1, self.lstm.hidden_size)
+            self.register_buffer('hidden', hidden.clone())
+            self.register_buffer('cell', cell.clone())
+            self.register_buffer('tail', constants[0, stop:].clone())
+            self.tail_length = len(self.tail)
+        self.eval()
+
+    def forward(self, x):
+        # (batch, 1, length) and (batch, length, 1) share the same memory layout
+        x = self.conv1(x.reshape(-1, self.window_size, 1))
+        x = self.conv2(x)
+        batch_size = x.shape[0]
+        if self.tail_length > 0:
+            x = torch.cat((x, self.tail.expand(batch_size, -1, -1)), dim=1)
+        state = (self.hidden.expand(1, batch_size, self.lstm.hidden_size).contiguous(), self.cell.expand(1, batch_size, self.lstm.hidden_size).contiguous())
+        output, _ = self.lstm(x, state)
+        return self.linear(output[:, -1, :])
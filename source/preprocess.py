@@ -1,11 +1,19 @@
+import concurrent.futures
+import contextlib
+import glob
+import json
+import multiprocessing
 import numpy as np
-import torch
-from utils import config
+from utils import config, data_cache
 from pathlib import Path
 from pedalboard.io import AudioFile
+import dataset
+
+# Number of frames decoded per read in the streaming path (4 MiB per channel for float32)
+CHUNK_FRAMES = 2**20
 
 def normalize(data):
-    data_norm = max(max(data), abs(min(data)))
+    data_norm = np.max(np.abs(data))
     return data / data_norm
 
 def load_and_process_audio(file_path):
@@ -13,18 +21,102 @@ def load_and_process_audio(file_path):
         data = f.read(f.frames).flatten().astype(np.float32)
     return normalize(data)
 
+def compute_peak(file_path, chunk_frames=CHUNK_FRAMES):
+    # Absolute peak of the file, decoded chunk by chunk
+    peak = np.float32(0)
+    with AudioFile(file_path) as f:
+        while f.tell() < f.frames:
+            chunk = f.read(chunk_frames)
+            peak = max(peak, np.max(np.abs(chunk)))
+    return peak
+
+def stream_and_process_audio(file_path, out=None, chunk_frames=CHUNK_FRAMES, peak=None):
+    """
+    Streaming version of load_and_process_audio. Decodes the file in chunks of chunk_frames
+    frames, once to find the peak and once to write the normalized signal into out, so that
+    apart from out the memory use is bounded by the chunk size. The result is identical to
+    load_and_process_audio (channels are concatenated one after another).
+
+    Args:
+        file_path (str): Path of the audio file.
+        out (np.ndarray, optional): Preallocated float32 buffer of length channels * frames,
+            e.g. a np.memmap to write straight to disk. Allocated if None.
+        chunk_frames (int): Number of frames decoded per read.
+        peak (np.float32, optional): Precomputed result of compute_peak, skips the first pass.
+
+    Returns:
+        np.ndarray: The normalized signal (out).
+    """
+    if peak is None:
+        peak = compute_peak(file_path, chunk_frames)
+    with AudioFile(file_path) as f:
+        frames = f.frames
+        if out is None:
+            out = np.empty(f.num_channels * frames, dtype=np.float32)
+        elif out.shape != (f.num_channels * frames,) or out.dtype.str[1:] != 'f4':
+            raise ValueError(f"out must be a float32 array of shape ({f.num_channels * frames},).")
+        channels = out.reshape(f.num_channels, frames)
+        while f.tell() < frames:
+            start = f.tell()
+            chunk = f.read(chunk_frames)
+            np.divide(chunk, peak, out=channels[:, start:start + chunk.shape[1]])
+    return out
+
+def audio_length(file_path):
+    # Number of samples load_and_process_audio returns for the file
+    with AudioFile(file_path) as f:
+        return f.num_channels * f.frames
+
+def split_index(length, test_split):
+    return int(length * (1 - test_split))
+
 def split_data(data, test_split):
-    split_idx = int(len(data) * (1 - test_split))
-    return np.split(data, [split_idx])
-
-def create_ordered_data(data, input_size):
-    indices = np.arange(input_size) + np.arange(len(data)-input_size+1)[:, np.newaxis]
-    indices = torch.from_numpy(indices)
-    data = torch.from_numpy(data)
-    ordered_data = torch.zeros_like(indices, dtype=torch.float32)
-    for i, idx in enumerate(indices):
-        ordered_data[i] = torch.gather(data, 0, idx)
-    return ordered_data.unsqueeze(1)
+    return np.split(data, [split_index(len(data), test_split)])
+
+def expand_files(files):
+    # A path, a glob pattern or a list of them, patterns are expanded in sorted order
+    files = [files] if isinstance(files, str) else files
+    expanded = []
+    for pattern in files:
+        expanded += sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+    return expanded
+
+def resolve_pairs(input_files, target_files):
+    """
+    Pairs the input and target files of the parameters, each a path, a glob pattern or a list
+    of them, by their position after expanding the patterns.
+    """
+    inputs, targets = expand_files(input_files), expand_files(target_files)
+    if not inputs or len(inputs) != len(targets):
+        raise ValueError(f"Found {len(inputs)} input and {len(targets)} target files, expected the same number of at least one.")
+    return list(zip(inputs, targets))
+
+def split_indices(lengths, test_split, split_mode):
+    """
+    Returns the index of the first testing sample of each file. 'per_file' tests on the end of every
+    file, 'holdout' tests on the last files as a whole, test_split of the files but at least one.
+    """
+    if split_mode == 'per_file':
+        return [split_index(length, test_split) for length in lengths]
+    if split_mode == 'holdout':
+        if len(lengths) < 2:
+            raise ValueError("Holding out files for testing needs at least two input/target pairs.")
+        test_files = min(len(lengths) - 1, max(1, round(len(lengths) * test_split)))
+        return [length if i < len(lengths) - test_files else 0 for i, length in enumerate(lengths)]
+    raise ValueError(f"Unknown split '{split_mode}', expected 'per_file' or 'holdout'.")
+
+def measure_pair(pair):
+    # Peaks and lengths of an input/target pair
+    return [(compute_peak(file_path), audio_length(file_path)) for file_path in pair]
+
+def write_shard(pair, paths, peaks):
+    # Streams the normalized signals of a pair straight into little-endian raw files that train.py memory-maps
+    for file_path, path, peak in zip(pair, paths, peaks):
+        # Remove the old file first instead of overwriting it, it may be hardlinked to a cache entry
+        path.unlink(missing_ok=True)
+        array = np.memmap(path, dtype=dataset.DTYPE, mode='w+', shape=(audio_length(file_path),))
+        stream_and_process_audio(file_path, out=array, peak=peak)
+        array.flush()
 
 def main():
     # Load the hyperparameters from the params yaml file into a Dictionary
@@ -35,33 +127,72 @@ def main():
     input_file = params['preprocess']['input_file']
     target_file = params['preprocess']['target_file']
     test_split = params['preprocess']['test_split']
+    split_mode = params['preprocess']['split']
+    workers = params['preprocess']['workers']
 
-    X_all = load_and_process_audio(input_file)
-    y_all = load_and_process_audio(target_file)
-    print("Data loaded and normalized.")
+    output_dir = Path('data/processed')
+    output_dir.mkdir(parents=True, exist_ok=True)
+    pairs = resolve_pairs(input_file, target_file)
+    shard_paths = [(output_dir / f'input_{i:04d}.f32', output_dir / f'target_{i:04d}.f32') for i in range(len(pairs))]
+    output_files = [path.name for paths in shard_paths for path in paths] + [dataset.MANIFEST_FILE]
+    print(f"Preprocessing {len(pairs)} input/target pairs.")
 
-    X_training, X_testing = split_data(X_all, test_split)
-    y_training, y_testing = split_data(y_all, test_split)
-    print("Data split into training and testing sets.")
+    params_hash = params.hash(['general.input_size', 'preprocess'])
 
-    X_ordered_training = create_ordered_data(X_training, input_size)
-    X_ordered_testing = create_ordered_data(X_testing, input_size)
-    print("Input data ordered.")
+    # Reuse the dataset of an earlier experiment with the same audio content, parameters and code.
+    # The file paths are not part of the key, the content of the files is
+    cache = data_cache.DatasetCache.from_env()
+    if cache is not None:
+        cache_params = ['general.input_size'] + [f'preprocess.{key}' for key in params['preprocess'] if key not in ('input_file', 'target_file', 'workers')]
+        cache_key = cache.key([file_path for pair in pairs for file_path in pair], params.hash(cache_params), [__file__, dataset.__file__])
+        if cache.fetch(cache_key, output_dir, output_files):
+            # The cached manifest names the files and parameters of the experiment that stored it
+            with open(output_dir / dataset.MANIFEST_FILE) as f:
+                manifest = json.load(f)
+            for shard, (input_path, target_path) in zip(manifest['shards'], pairs):
+                shard['sources'] = {'input': str(input_path), 'target': str(target_path)}
+            manifest['params_hash'] = params_hash
+            dataset.save_manifest(output_dir, manifest)
+            print(f"Preprocessed data found in cache {cache.cache_dir} ({cache_key[:12]}).")
+            return
 
-    y_ordered_training = torch.from_numpy(y_training[input_size-1:]).unsqueeze(1)
-    y_ordered_testing = torch.from_numpy(y_testing[input_size-1:]).unsqueeze(1)
-    print("Target data ordered.")
+    # The files are decoded in parallel, once for the peaks and once to write the shards
+    workers = max(1, min(workers, len(pairs)))
+    pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) if workers > 1 else contextlib.nullcontext()
+    with pool as executor:
+        map_pairs = map if executor is None else executor.map
+        measurements = list(map_pairs(measure_pair, pairs))
+        for (input_path, target_path), ((_, input_length), (_, target_length)) in zip(pairs, measurements):
+            if input_length != target_length:
+                raise ValueError(f"Input and target files differ in length ({input_path}: {input_length} != {target_path}: {target_length}).")
+        # All files are divided by the same peaks, so the level differences between the captures are kept
+        peaks = {name: max(measurement[i][0] for measurement in measurements) for i, name in enumerate(('input', 'target'))}
+        list(map_pairs(write_shard, pairs, shard_paths, [(peaks['input'], peaks['target'])] * len(pairs)))
+    print("Data loaded and normalized.")
 
-    output_file_path = Path('data/processed/data.pt')
-    output_file_path.parent.mkdir(parents=True, exist_ok=True)
+    # Only the 1-D signals are stored, the windows are created as strided views in train.py
+    lengths = [measurement[0][1] for measurement in measurements]
+    split_idxs = split_indices(lengths, test_split, split_mode)
+    for (input_path, _), length, split_idx in zip(pairs, lengths, split_idxs):
+        parts = [part for part in (split_idx, length - split_idx) if split_mode == 'per_file' or part > 0]
+        if min(parts) < input_size:
+            raise ValueError(f"Training and testing sets of {input_path} must contain at least input_size={input_size} samples.")
+    print("Data split into training and testing sets.")
 
-    torch.save({
-        'X_ordered_training': X_ordered_training,
-        'y_ordered_training': y_ordered_training,
-        'X_ordered_testing': X_ordered_testing,
-        'y_ordered_testing': y_ordered_testing
-    }, output_file_path)
+    shards = []
+    for pair, (input_path, target_path), length, split_idx in zip(pairs, shard_paths, lengths, split_idxs):
+        shards.append({
+            'input': np.memmap(input_path, dtype=dataset.DTYPE, mode='r', shape=(length,)),
+            'target': np.memmap(target_path, dtype=dataset.DTYPE, mode='r', shape=(length,)),
+            'sources': {'input': pair[0], 'target': pair[1]},
+            'split_index': split_idx,
+        })
+    dataset.write_manifest(output_dir, shards, input_size, peaks, params_hash)
     print("Preprocessing done and data saved.")
 
+    if cache is not None:
+        cache.store(cache_key, output_dir, output_files)
+        print(f"Preprocessed data added to cache {cache.cache_dir} ({cache_key[:12]}).")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Renders the WAV files of a directory with a trained model, e.g. to process a capture library.
+
+Each file is read and processed in chunks, with the last input_size - 1 samples of the previous chunk
+as context, so memory stays bounded and the output equals the windowed model applied to the whole file.
+Files are processed in parallel by a pool of processes, which divide the CPUs of the job between them.
+The model is a PyTorch checkpoint (.pth), run with StreamingInference, or an ONNX export (.onnx), run
+with ONNX Runtime. The inputs are scaled by the peaks of the training data like in preprocess.py.
+
+Usage:
+    python source/render.py  (the render stage, with the parameters of params.yaml)
+    python source/render.py --input-dir captures/ --output-dir rendered/ --model models/exports/model.onnx --workers 4
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import torch
+from utils import config
+from model import NeuralNetwork
+from streaming import StreamingInference
+from dataset import MANIFEST_FILE
+from pathlib import Path
+from pedalboard.io import AudioFile
+
+# Creates a stream per channel with the model of the worker process, set by the pool initializer
+_create_stream = None
+
+class OnnxStreamingInference:
+    """
+    The ONNX Runtime counterpart of StreamingInference: keeps the last input_size - 1 input samples
+    between blocks and runs the windows of every block through the session in batches.
+    """
+
+    def __init__(self, session, input_size, batch_size=4096):
+        self.session = session
+        self.input_size = input_size
+        self.batch_size = batch_size
+        self.history = np.zeros(input_size - 1, dtype=np.float32)
+
+    def process(self, block):
+        segment = np.concatenate((self.history, np.asarray(block, dtype=np.float32)))
+        windows = np.lib.stride_tricks.sliding_window_view(segment, self.input_size)[:, None, :]
+        output = np.concatenate([self.session.run(None, {'input': np.ascontiguousarray(windows[i:i + self.batch_size])})[0]
+                                 for i in range(0, len(windows), self.batch_size)])
+        self.history = segment[len(segment) - len(self.history):]
+        return output.reshape(-1)
+
+def _init_worker(model_path, input_size, model_params, workers):
+    global _create_stream
+    # The workers divide the CPUs of the job like processes started by torchrun
+    os.environ['LOCAL_WORLD_SIZE'] = str(workers)
+    threads = config.setup_cpu_runtime()['intra_op_threads']
+    if Path(model_path).suffix == '.onnx':
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        session = onnxruntime.InferenceSession(str(model_path), options, providers=['CPUExecutionProvider'])
+        _create_stream = lambda: OnnxStreamingInference(session, input_size)
+    else:
+        model = NeuralNetwork(model_params['conv1d_filters'], model_params['conv1d_strides'], model_params['hidden_units'])
+        model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
+        _create_stream = lambda: StreamingInference(model, input_size)
+
+def render_file(input_path, output_path, chunk_seconds, input_peak, target_peak):
+    """
+    Renders one file chunk by chunk with the model of the worker process, every channel with its own stream.
+
+    Returns:
+        dict: Duration of the audio, processing time and real-time factor (processing time / duration).
+    """
+    start = time.perf_counter()
+    with AudioFile(str(input_path)) as f:
+        sample_rate, num_channels, frames = f.samplerate, f.num_channels, f.frames
+        chunk_frames = max(1, int(chunk_seconds * sample_rate))
+        streams = [_create_stream() for _ in range(num_channels)]
+        with AudioFile(str(output_path), 'w', sample_rate, num_channels, bit_depth=32) as out:
+            while f.tell() < frames:
+                chunk = f.read(chunk_frames) / input_peak
+                output = np.stack([np.asarray(stream.process(channel)) for stream, channel in zip(streams, chunk)])
+                out.write((output * target_peak).astype(np.float32))
+    seconds = time.perf_counter() - start
+    duration = frames / sample_rate
+    return {'duration_seconds': round(duration, 3), 'processing_seconds': round(seconds, 3), 'real_time_factor': round(seconds / duration, 5)}
+
+def read_peaks(processed_dir=Path('data/processed')):
+    # The model was trained on signals divided by these peaks
+    try:
+        with open(Path(processed_dir) / MANIFEST_FILE) as f:
+            peaks = json.load(f)['peak']
+        return peaks['input'], peaks['target']
+    except FileNotFoundError:
+        print(f"No {MANIFEST_FILE} in {processed_dir}, the audio is rendered without scaling.")
+        return 1.0, 1.0
+
+def main():
+    params = config.Params()
+    render_params = params['render']
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input-dir', default=render_params['input_dir'], help='Directory of the WAV files to render.')
+    parser.add_argument('--output-dir', default=render_params['output_dir'], help='Directory of the rendered WAV files.')
+    parser.add_argument('--model', default=render_params['model'], help='A checkpoint (.pth) or an ONNX export (.onnx).')
+    parser.add_argument('--chunk-seconds', type=float, default=render_params['chunk_seconds'], help='Audio read and processed at once.')
+    parser.add_argument('--workers', type=int, default=render_params['workers'], help='Files rendered in parallel.')
+    parser.add_argument('--report', default='metrics/render.json', help='The JSON file for the real-time factors.')
+    args = parser.parse_args()
+
+    input_size = params['general']['input_size']
+    input_files = sorted(Path(args.input_dir).glob('*.wav'))
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    input_peak, target_peak = read_peaks()
+
+    if not input_files:
+        print(f"No WAV files in {args.input_dir}, nothing to render.")
+    workers = max(1, min(args.workers, len(input_files)))
+    print(f"Rendering {len(input_files)} files with {workers} worker processes.")
+
+    start = time.perf_counter()
+    files = {}
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(args.model, input_size, params['model'], workers),
+    ) as executor:
+        futures = {
+            executor.submit(render_file, path, output_dir / path.name, args.chunk_seconds, input_peak, target_peak): path
+            for path in input_files
+        }
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            files[path.name] = future.result()
+            print(f"{path.name}: {files[path.name]['duration_seconds']:.1f} s of audio in "
+                  f"{files[path.name]['processing_seconds']:.1f} s, real-time factor {files[path.name]['real_time_factor']:.4f}")
+
+    wall_seconds = time.perf_counter() - start
+    duration = sum(result['duration_seconds'] for result in files.values())
+    report = {
+        'files': len(files),
+        'workers': workers,
+        'model': str(args.model),
+        'duration_seconds': round(duration, 3),
+        'wall_seconds': round(wall_seconds, 3),
+        'real_time_factor': round(wall_seconds / duration, 5) if duration else None,
+        'per_file': dict(sorted(files.items())),
+    }
+    report_path = Path(args.report)
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Rendered {duration:.1f} s of audio in {wall_seconds:.1f} s (real-time factor {report['real_time_factor']}).")
+
+if __name__ == "__main__":
+    main()
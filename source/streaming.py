@@ -0,0 +1,54 @@
+import torch
+
+class StreamingInference:
+    """
+    Stateful streaming inference with the weights of a trained NeuralNetwork.
+
+    Accepts blocks of new input samples of arbitrary size and returns one output sample per input
+    sample, equal to the windowed model applied to the window ending at that sample. Between calls
+    it keeps the last input_size - 1 input samples, which is all the convolutions need to continue,
+    and the LSTM state after the padding-only steps, which is the same for every window.
+    The stream starts from silence, i.e. the history is initialized with zeros.
+
+    Args:
+        model (NeuralNetwork): The trained model.
+        input_size (int): Number of input samples per window (general.input_size).
+    """
+
+    def __init__(self, model, input_size):
+        self.model = model.eval()
+        self.input_size = input_size
+        device = next(model.parameters()).device
+        with torch.no_grad():
+            self.padding_state = model.padding_state() if model.padding_steps() > 0 else None
+        self.history = torch.zeros(input_size - 1, device=device)
+
+    def reset(self):
+        self.history.zero_()
+
+    @torch.no_grad()
+    def process(self, block):
+        """
+        Processes a block of new input samples.
+
+        Args:
+            block (torch.Tensor or np.ndarray): 1-D block of input samples.
+
+        Returns:
+            torch.Tensor: 1-D output block of the same length.
+        """
+        block = torch.as_tensor(block, dtype=torch.float32, device=self.history.device)
+        if len(block) == 0:
+            return block
+        segment = torch.cat((self.history, block))
+        output = self.model.forward_windows(segment.view(1, 1, -1), self.input_size, self.padding_state)
+        self.history = segment[len(segment) - len(self.history):]
+        return output.view(-1)
+
+    def render(self, signal, block_size=65536):
+        """Processes a whole 1-D signal block by block into a preallocated output."""
+        signal = torch.as_tensor(signal, dtype=torch.float32)
+        output = torch.empty(len(signal), device=self.history.device)
+        for start in range(0, len(signal), block_size):
+            output[start:start + block_size] = self.process(signal[start:start + block_size])
+        return output
@@ -1,55 +1,109 @@
 import torch
 import torchinfo
-from utils import logs, config
+from utils import logs, config, checkpoints, distributed, asha, profiling, batch_tuning
 from pathlib import Path
-from model import NeuralNetwork
+from model import NeuralNetwork, WindowsForward
+from dataset import WindowDataset, WindowBatcher, SegmentBatcher, load_processed_data
 
-def train_epoch(dataloader, model, loss_fn, optimizer, device, writer, epoch):
-    size = len(dataloader.dataset)
+def train_epoch(dataloader, model, loss_fn, optimizer, device, writer, epoch, log_interval, forward=None, stop_signal=None, profiler=None):
+    # forward maps a batch to predictions and defaults to the model itself
+    forward = forward or model
+    # The phases of the steps are only timed if profiling is enabled in params.yaml
+    profiler = profiler or profiling.Profiler(device)
+    # The samples of this rank, a shard of the dataset in distributed training
+    size = dataloader.num_samples
     num_batches = len(dataloader)
     train_loss = 0 
+    # Batch losses stay on the device and are only read back every log_interval batches
+    # to avoid a host synchronization per batch
+    batch_losses = torch.zeros(log_interval, device=device)
     model.train()
-    for batch, (X, y) in enumerate(dataloader):
-        X, y = X.to(device), y.to(device)
-        pred = model(X)
-        loss = loss_fn(pred, y)
-        loss.backward()
-        optimizer.step()
-        optimizer.zero_grad()
-        writer.add_scalar("Batch_Loss/train", loss.item(), batch + epoch * len(dataloader))
-        train_loss += loss.item()
-        if batch % 100 == 0:
-            loss_value = loss.item()
-            current = (batch + 1) * len(X)
-            print(f"loss: {loss_value:>7f}  [{current:>5d}/{size:>5d}]")
+    for batch, (X, y) in enumerate(profiler.iterate(dataloader, "train/data")):
+        with profiler.phase("train/to_device"):
+            X, y = X.to(device), y.to(device)
+        with profiler.phase("train/forward"):
+            pred = forward(X)
+            loss = loss_fn(pred, y)
+        with profiler.phase("train/backward"):
+            loss.backward()
+        with profiler.phase("train/optimizer"):
+            optimizer.step()
+            optimizer.zero_grad()
+        batch_losses[batch % log_interval] = loss.detach()
+        # The epoch is cut short if a termination signal arrived. The signal is only checked when logging,
+        # as in distributed training each check synchronizes the ranks
+        logging_batch = (batch + 1) % log_interval == 0 or batch + 1 == num_batches
+        stopping = logging_batch and stop_signal is not None and stop_signal.check()
+        if logging_batch:
+            with profiler.phase("train/logging"):
+                first_batch = batch - batch % log_interval
+                loss_values = batch_losses[:batch % log_interval + 1].tolist()
+                # Aggregated into windows with a bounded number of points, see logs.MetricsRecorder
+                if writer is not None:
+                    writer.add_aggregated_scalars("Batch_Loss/train", loss_values, first_batch + epoch * num_batches)
+                for loss_value in loss_values:
+                    train_loss += loss_value
+                current = min((batch + 1) * dataloader.batch_size, size)
+                print(f"loss: {loss_values[-1]:>7f}  [{current:>5d}/{size:>5d}]")
+        profiler.step()
+        if stopping:
+            break
     train_loss /=  num_batches
     return train_loss
     
-def test_epoch(dataloader, model, loss_fn, device, writer):
+def test_epoch(dataloader, model, loss_fn, device, writer, audio_length=0, profiler=None):
+    """
+    Computes the test loss and, in the same pass, renders the prediction for the first
+    audio_length samples of the test set into a preallocated buffer. Returns the test loss
+    and the prediction and target audio, which are None if audio_length is 0.
+    """
+    profiler = profiler or profiling.Profiler(device)
     num_batches = len(dataloader)
+    audio_length = min(audio_length, len(dataloader.dataset))
     model.eval()
-    test_loss = 0
+    batch_losses = torch.zeros(num_batches, device=device)
+    prediction = torch.empty(audio_length, device=device) if audio_length > 0 else None
+    # Filled from the batches like the prediction, as the windows skip the file boundaries of the targets
+    target = torch.empty(audio_length, device=device) if audio_length > 0 else None
     with torch.no_grad():
-        for X, y in dataloader:
-            X, y = X.to(device), y.to(device)
-            pred = model(X)
-            test_loss += loss_fn(pred, y).item()
-    test_loss /= num_batches
+        current = 0
+        for batch, (X, y) in enumerate(profiler.iterate(dataloader, "test/data")):
+            with profiler.phase("test/to_device"):
+                X, y = X.to(device), y.to(device)
+            with profiler.phase("test/forward"):
+                pred = model(X)
+                batch_losses[batch] = loss_fn(pred, y)
+            if current < audio_length:
+                with profiler.phase("test/audio"):
+                    n = min(len(pred), audio_length - current)
+                    prediction[current:current + n] = pred[:n, 0]
+                    target[current:current + n] = y[:n, 0]
+            current += len(X)
+    # Summed on the host in batch order, as the per-batch values were before
+    test_loss = sum(batch_losses.tolist()) / num_batches
     print(f"Test Error: \n Avg loss: {test_loss:>8f} \n")
-    return test_loss
+    return test_loss, prediction, target
 
-def generate_audio_examples(model, device, dataloader):
-    print("Running audio prediction...")
-    prediction = torch.zeros(0).to(device)
-    target = torch.zeros(0).to(device)
-    with torch.no_grad():
-        for X, y in dataloader:
-            X = X.to(device)
-            y = y.to(device)
-            predicted_batch = model(X)
-            prediction = torch.cat((prediction, predicted_batch.flatten()), 0)
-            target = torch.cat((target, y.flatten()), 0)
-    return prediction, target
+def checkpoint_state(model, optimizer, epoch, writer, params):
+    # Everything needed to continue training at the given epoch
+    return {
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'epoch': epoch,
+        'rng_states': checkpoints.get_rng_states(),
+        'writer_step': writer.current_step,
+        'tensorboard_path': str(writer.log_dir),
+        'params_hash': params.hash()
+    }
+
+def exit_on_signal(stop_signal, checkpoint_manager, writer):
+    # Waits for the final checkpoint to be written and exits with the conventional status for the signal
+    checkpoint_manager.close()
+    if writer is not None:
+        writer.close()
+        print(f"Saved checkpoint to {checkpoint_manager.path}, exiting.")
+    distributed.cleanup()
+    raise SystemExit(128 + stop_signal.received)
 
 def main():
     # Load the hyperparameters from the params yaml file into a Dictionary
@@ -62,66 +116,202 @@ def main():
     batch_size = params['train']['batch_size']
     learning_rate = params['train']['learning_rate']
     device_request = params['train']['device_request']
+    log_interval = params['train']['log_interval']
+    training_mode = params['train']['mode']
+    segment_length = params['train']['segment_length']
+    audio_interval = params['train']['audio_interval']
+    audio_excerpt_seconds = params['train']['audio_excerpt_seconds']
     conv1d_strides = params['model']['conv1d_strides']
     conv1d_filters = params['model']['conv1d_filters']
     hidden_units = params['model']['hidden_units']
-
-    # Create a SummaryWriter object to write the tensorboard logs
-    tensorboard_path = logs.return_tensorboard_path()
-    metrics = {'Epoch_Loss/train': None, 'Epoch_Loss/test': None, 'Batch_Loss/train': None}
-    writer = logs.CustomSummaryWriter(log_dir=tensorboard_path, params=params, metrics=metrics)
+    checkpoint_interval = params['train']['checkpoint_interval']
+    scalar_budget = params['train']['scalar_budget']
+    cpu_pinning = params['train']['cpu_pinning']
 
     # Set a random seed for reproducibility across all devices. Add more devices if needed
     config.set_random_seeds(random_seed)
+    # Use as many CPU threads as CPUs are allocated to this job, so that jobs sharing a node do not oversubscribe it.
+    # The batchers gather the batches in the training process, so no CPUs are reserved for DataLoader workers
+    cpu_runtime = config.setup_cpu_runtime(pin=cpu_pinning)
     # Prepare the requested device for training. Use cpu if the requested device is not available 
     device = config.prepare_device(device_request)
+    # Join the process group if started by torchrun or srun with several tasks. Only rank 0 writes logs and checkpoints
+    rank, world_size, device = distributed.setup(device)
+    is_main_process = distributed.is_main_process()
 
-    # Load preprocessed data from the input file into the training and testing tensors
-    input_file_path = Path('data/processed/data.pt')
-    data = torch.load(input_file_path)
-    X_ordered_training = data['X_ordered_training']
-    y_ordered_training = data['y_ordered_training']
-    X_ordered_testing = data['X_ordered_testing']
-    y_ordered_testing = data['y_ordered_testing']
+    # With batch_size 'auto', rank 0 probes the batch size with the best throughput on this device once, later runs read it from the cache
+    if batch_size == 'auto':
+        def create_forward():
+            model = NeuralNetwork(conv1d_filters, conv1d_strides, hidden_units).to(device)
+            return WindowsForward(model, input_size) if training_mode == 'segment' else model
+        if is_main_process:
+            batch_size = batch_tuning.tuned_batch_size(params['model'], create_forward, input_size, device, training_mode, segment_length)
+        batch_size = int(distributed.all_reduce_max(batch_size if is_main_process else 0))
+
+    # Look for a checkpoint of an interrupted run of this DVC experiment with the same parameters
+    checkpoint = None
+    if checkpoint_interval > 0:
+        checkpoint_manager = checkpoints.CheckpointManager(checkpoints.return_checkpoint_dir())
+        checkpoint = checkpoint_manager.load()
+        if checkpoint is not None and checkpoint['params_hash'] != params.hash():
+            print(f"Ignoring checkpoint {checkpoint_manager.path} with different parameters.")
+            checkpoint = None
+        # Write a final checkpoint when SLURM terminates the job
+        stop_signal = checkpoints.StopSignal()
+    else:
+        checkpoint_manager = None
+        stop_signal = None
+
+    # Open the preprocessed data as memory-mapped training and testing tensors, one per file
+    data = load_processed_data(Path('data/processed'))
+    if data['input_size'] != input_size:
+        raise ValueError(f"Preprocessed data has input_size={data['input_size']}, expected {input_size}. Rerun preprocess.py.")
+    X_training = data['X_training']
+    y_training = data['y_training']
+    X_testing = data['X_testing']
+    y_testing = data['y_testing']
 
     # Create the model
     model = NeuralNetwork(conv1d_filters, conv1d_strides, hidden_units).to(device)
-    summary = torchinfo.summary(model, (1, 1, input_size), device=device)
-    print(summary)
-
-    # Add the model graph to the tensorboard logs
-    sample_inputs = torch.randn(1, 1, input_size) 
-    writer.add_graph(model, sample_inputs.to(device))
+    if is_main_process:
+        summary = torchinfo.summary(model, (1, 1, input_size), device=device)
+        print(summary)
 
     # Define the loss function and the optimizer
     loss_fn = torch.nn.MSELoss(reduction='mean')
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
 
-    # Create the dataloaders
-    training_dataset = torch.utils.data.TensorDataset(X_ordered_training, y_ordered_training)
-    training_dataloader = torch.utils.data.DataLoader(training_dataset, batch_size=batch_size, shuffle=True)
-    testing_dataset = torch.utils.data.TensorDataset(X_ordered_testing, y_ordered_testing)
-    testing_dataloader = torch.utils.data.DataLoader(testing_dataset, batch_size=batch_size, shuffle=False)
+    # Restore the training state of the interrupted run
+    start_epoch = 0
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        checkpoints.set_rng_states(checkpoint['rng_states'])
+        start_epoch = checkpoint['epoch']
+        print(f"Resuming from checkpoint {checkpoint_manager.path} at epoch {start_epoch + 1}")
+
+    # Create the batchers, which move the signals to the device once and gather each batch in one operation.
+    # In distributed training each rank iterates over its own shard of batch_size windows per batch
+    training_dataset = WindowDataset(X_training, y_training, input_size)
+    shard = {'rank': rank, 'world_size': world_size, 'seed': random_seed}
+    if training_mode == 'window':
+        training_dataloader = WindowBatcher(training_dataset, batch_size=batch_size, shuffle=True, device=device, **shard)
+        training_forward = model
+    elif training_mode == 'segment':
+        # Contiguous segments, each predicting segment_length targets in one pass with about batch_size targets per batch
+        segments_per_batch = max(1, batch_size // segment_length)
+        training_dataloader = SegmentBatcher(training_dataset, segment_length, segments_per_batch, shuffle=True, device=device, **shard)
+        training_forward = WindowsForward(model, input_size)
+    else:
+        raise ValueError(f"Unknown training mode '{training_mode}', expected 'window' or 'segment'.")
+    training_dataloader.epoch = start_epoch
+
+    # Create a SummaryWriter object to write the tensorboard logs. A resumed run continues its previous logs
+    metrics = {'Epoch_Loss/train': None, 'Epoch_Loss/test': None, 'Batch_Loss/train': None}
+    if not is_main_process:
+        writer = None
+    elif checkpoint is None:
+        tensorboard_path = logs.return_tensorboard_path()
+        # The HParams record shows the batch size that is used, also if it was tuned, and the CPU runtime configuration
+        logged_params = params.with_overrides({'train.batch_size': batch_size})
+        logged_params['runtime'] = cpu_runtime
+        writer = logs.CustomSummaryWriter(log_dir=tensorboard_path, params=logged_params, metrics=metrics, scalar_budget=scalar_budget)
+    else:
+        tensorboard_path = Path(checkpoint['tensorboard_path'])
+        # Events of the interrupted run from the repeated batches on are discarded
+        writer = logs.CustomSummaryWriter(log_dir=tensorboard_path, scalar_budget=scalar_budget,
+                                          purge_step=checkpoint['epoch'] * len(training_dataloader))
+        writer.current_step = checkpoint['writer_step']
+
+    # Add the model graph to the tensorboard logs
+    if is_main_process and checkpoint is None:
+        sample_inputs = torch.randn(1, 1, input_size) 
+        writer.add_graph(model, sample_inputs.to(device))
+
+    if writer is not None:
+        writer.metrics_recorder.configure("Batch_Loss/train", len(training_dataloader) * epochs)
+    if world_size > 1:
+        training_forward = torch.nn.parallel.DistributedDataParallel(training_forward, device_ids=[device.index] if device.type == 'cuda' else None)
+    # Only rank 0 evaluates, so only rank 0 moves the test signals to its device
+    if is_main_process:
+        testing_dataset = WindowDataset(X_testing, y_testing, input_size)
+        testing_dataloader = WindowBatcher(testing_dataset, batch_size=batch_size, shuffle=False, device=device)
+
+        # Audio is rendered every audio_interval epochs and after the last epoch, optionally only for an excerpt
+        sample_rate = 44100
+        if audio_excerpt_seconds is None:
+            audio_excerpt_length = len(testing_dataset)
+        else:
+            audio_excerpt_length = int(audio_excerpt_seconds * sample_rate)
+
+    # The epochs are always timed. Profiling the phases of the steps and the trace are switched on in params.yaml
+    profiler = profiling.Profiler.from_params(params, device, trace_dir=writer.log_dir if is_main_process else None)
+
+    # In a sweep with ASHA, the trial stops early if its test loss is not among the best at an epoch budget
+    trial_scheduler = asha.TrialScheduler.from_env(epochs)
+    epochs_run = epochs
 
     # Training loop
-    for t in range(epochs):
+    for t in range(start_epoch, epochs):
         print(f"Epoch {t+1}\n-------------------------------")
-        epoch_loss_train = train_epoch(training_dataloader, model, loss_fn, optimizer, device, writer, epoch=t)
-        epoch_loss_test = test_epoch(testing_dataloader, model, loss_fn, device, writer)
-        epoch_audio_prediction, epoch_audio_target  = generate_audio_examples(model, device, testing_dataloader)
-        writer.add_scalar("Epoch_Loss/train", epoch_loss_train, t)
-        writer.add_scalar("Epoch_Loss/test", epoch_loss_test, t)
-        writer.add_audio("Audio/prediction", epoch_audio_prediction, t, sample_rate=44100)
-        writer.add_audio("Audio/target", epoch_audio_target, t, sample_rate=44100)        
-        writer.step()  
-
-    writer.close()
-
-    # Save the model checkpoint
-    output_file_path = Path('models/checkpoints/model.pth')
-    output_file_path.parent.mkdir(parents=True, exist_ok=True)
-    torch.save(model.state_dict(), output_file_path)
-    print("Saved PyTorch Model State to model.pth")
+        with profiler.epoch("train", samples=training_dataloader.num_samples):
+            epoch_loss_train = train_epoch(training_dataloader, model, loss_fn, optimizer, device, writer, epoch=t, log_interval=log_interval, forward=training_forward, stop_signal=stop_signal, profiler=profiler)
+        if stop_signal is not None and stop_signal.received is not None:
+            # The interrupted epoch is repeated on resume
+            if is_main_process:
+                checkpoint_manager.save(checkpoint_state(model, optimizer, t, writer, params))
+            exit_on_signal(stop_signal, checkpoint_manager, writer)
+        epoch_loss_train = distributed.all_reduce_mean(epoch_loss_train)
+        # Only rank 0 evaluates, the other ranks wait in the next collective
+        promoted = True
+        if is_main_process:
+            render_audio = audio_interval > 0 and ((t + 1) % audio_interval == 0 or t + 1 == epochs)
+            audio_length = audio_excerpt_length if render_audio else 0
+            with profiler.epoch("test", samples=testing_dataloader.num_samples):
+                epoch_loss_test, epoch_audio_prediction, epoch_audio_target = test_epoch(testing_dataloader, model, loss_fn, device, writer, audio_length, profiler=profiler)
+            with profiler.phase("logging"):
+                writer.add_scalar("Epoch_Loss/train", epoch_loss_train, t)
+                writer.add_scalar("Epoch_Loss/test", epoch_loss_test, t)
+                if render_audio:
+                    # Encoded and written in the background, see logs.MediaLogger
+                    writer.add_audio_async("Audio/prediction", epoch_audio_prediction, t, sample_rate=sample_rate)
+                    writer.add_audio_async("Audio/target", epoch_audio_target, t, sample_rate=sample_rate)
+            profiler.end_epoch(writer, t)
+            writer.step()  
+            promoted = trial_scheduler is None or trial_scheduler.report(t + 1, epoch_loss_test)
+        # Rank 0 decides, the other ranks follow
+        if trial_scheduler is not None and distributed.all_reduce_max(0 if promoted else 1) and t + 1 < epochs:
+            # Finish like a completed run, so the stage succeeds with the model of the last epoch
+            epochs_run = t + 1
+            print(f"Stopped early by ASHA after epoch {epochs_run}.")
+            break
+        stopping = stop_signal is not None and stop_signal.check()
+        if is_main_process and checkpoint_manager is not None and ((t + 1) % checkpoint_interval == 0 or stopping):
+            checkpoint_manager.save(checkpoint_state(model, optimizer, t + 1, writer, params))
+        if stopping:
+            exit_on_signal(stop_signal, checkpoint_manager, writer)
+
+    if is_main_process:
+        # The trace and the profile metrics are written before the logs are closed and synchronized
+        profiler.close()
+        profiler.save_metrics(Path('metrics/profile.json'))
+        writer.close()
+        if trial_scheduler is not None:
+            trial_scheduler.finish(epochs_run, stopped=epochs_run < epochs)
+
+        # Save the model checkpoint
+        output_file_path = Path('models/checkpoints/model.pth')
+        output_file_path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save(model.state_dict(), output_file_path)
+        print("Saved PyTorch Model State to model.pth")
+
+    # The experiment finished, a resubmission with the same name starts over
+    if checkpoint_manager is not None:
+        if is_main_process:
+            checkpoint_manager.remove()
+        checkpoint_manager.close()
+    distributed.barrier()
+    distributed.cleanup()
 
     print("Done with the training stage!")
 
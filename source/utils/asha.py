@@ -0,0 +1,163 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+This module implements asynchronous successive halving (ASHA) to stop unpromising trials of a sweep early.
+
+The trials coordinate through a file-based store, a directory on a filesystem shared by all trials:
+
+    config.json                     min_epochs and reduction_factor of the sweep
+    rungs/<epochs>/<trial>.json     test loss of a trial when it reached the epoch budget of a rung
+    trials/<trial>.json             epochs run by a finished or stopped trial
+
+Each trial reports its test loss after every epoch. At the epoch budgets min_epochs * reduction_factor^k
+it records the loss in the rung and is only promoted to the next budget if the loss ranks within the
+best 1 / reduction_factor of all losses recorded at that rung so far. No central process is needed and
+trials never wait for each other, so a trial that reaches a rung early is compared with fewer results.
+"""
+
+import json
+import math
+import os
+from pathlib import Path, PosixPath
+from typing import Any, Dict, List, Optional, Union
+
+STORE_ENV_VARIABLE = "TUSTU_ASHA_STORE"
+TRIAL_ENV_VARIABLE = "TUSTU_TRIAL_HASH"
+
+
+def _write_json(path: Path, data: Any) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+def _read_json_dir(directory: Path) -> Dict[str, Any]:
+    """Reads all JSON files in a directory by file stem, skipping files that vanish or are incomplete."""
+    results = {}
+    for path in sorted(directory.glob("*.json")):
+        try:
+            with open(path, "r") as file:
+                results[path.stem] = json.load(file)
+        except (OSError, json.JSONDecodeError):
+            continue
+    return results
+
+
+def rung_epochs(min_epochs: int, reduction_factor: int, max_epochs: int) -> List[int]:
+    """
+    Returns the epoch budgets at which trials are compared, min_epochs * reduction_factor^k below max_epochs.
+
+    Args:
+        min_epochs (int): The epochs every trial runs before it can be stopped.
+        reduction_factor (int): The factor between the budgets of consecutive rungs.
+        max_epochs (int): The epochs of a trial that is never stopped (train.epochs).
+
+    Returns:
+        List[int]: The epoch budgets of the rungs in ascending order.
+    """
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= reduction_factor
+    return rungs
+
+
+def write_config(store_dir: Union[str, PosixPath], min_epochs: int, reduction_factor: int) -> None:
+    """Creates the store of a sweep with the scheduler settings."""
+    if min_epochs < 1 or reduction_factor < 2:
+        raise ValueError("ASHA needs min_epochs >= 1 and reduction_factor >= 2.")
+    _write_json(Path(store_dir) / "config.json", {"min_epochs": min_epochs, "reduction_factor": reduction_factor})
+
+
+class TrialScheduler:
+    """
+    Decides for one trial after each epoch whether it continues, based on the results of the other trials.
+
+    Args:
+        store_dir (Union[str, PosixPath]): The store directory of the sweep.
+        trial_id (str): The identifier of the trial, the parameter hash.
+        max_epochs (int): The epochs of the trial if it is never stopped.
+    """
+
+    def __init__(self, store_dir: Union[str, PosixPath], trial_id: str, max_epochs: int):
+        self.store_dir = Path(store_dir)
+        self.trial_id = trial_id
+        self.max_epochs = max_epochs
+        with open(self.store_dir / "config.json", "r") as file:
+            settings = json.load(file)
+        self.reduction_factor = settings["reduction_factor"]
+        self.rungs = rung_epochs(settings["min_epochs"], self.reduction_factor, max_epochs)
+
+    @classmethod
+    def from_env(cls, max_epochs: int) -> Optional["TrialScheduler"]:
+        """
+        Creates the scheduler of a trial started by a sweep with ASHA, which sets TUSTU_ASHA_STORE and TUSTU_TRIAL_HASH.
+
+        Returns:
+            Optional[TrialScheduler]: The scheduler, or None if the run is not part of such a sweep.
+        """
+        store_dir = os.getenv(STORE_ENV_VARIABLE)
+        trial_id = os.getenv(TRIAL_ENV_VARIABLE)
+        if not store_dir or not trial_id:
+            return None
+        return cls(store_dir, trial_id, max_epochs)
+
+    def report(self, epochs: int, loss: float) -> bool:
+        """
+        Reports the test loss after the given number of completed epochs.
+
+        Args:
+            epochs (int): The number of completed epochs.
+            loss (float): The test loss (Epoch_Loss/test).
+
+        Returns:
+            bool: True if the trial continues, False if it should stop. A diverged trial, whose loss is
+                NaN or infinite, always stops.
+        """
+        if epochs not in self.rungs:
+            return True
+        # A NaN would compare as smaller than nothing and rank first, so diverged trials rank last
+        finite = math.isfinite(loss)
+        loss = loss if finite else math.inf
+        rung_dir = self.store_dir / "rungs" / str(epochs)
+        _write_json(rung_dir / f"{self.trial_id}.json", {"loss": loss})
+        losses = [result["loss"] for result in _read_json_dir(rung_dir).values()]
+        rank = sum(other < loss for other in losses)
+        promoted = finite and rank < math.ceil(len(losses) / self.reduction_factor)
+        print(f"ASHA rung at epoch {epochs}: rank {rank + 1} of {len(losses)}, {'promoted' if promoted else 'stopped'}.")
+        return promoted
+
+    def finish(self, epochs: int, stopped: bool) -> None:
+        """Records the epochs the trial ran, for the compute report of the sweep."""
+        _write_json(
+            self.store_dir / "trials" / f"{self.trial_id}.json",
+            {"epochs": epochs, "max_epochs": self.max_epochs, "stopped": stopped},
+        )
+
+
+def summarize(store_dir: Union[str, PosixPath]) -> Dict[str, Any]:
+    """
+    Summarizes the compute of the finished trials of a sweep compared to running all of them for max_epochs.
+
+    Args:
+        store_dir (Union[str, PosixPath]): The store directory of the sweep.
+
+    Returns:
+        Dict[str, Any]: The number of trials and stopped trials, the epochs run, the epochs without early
+            stopping and the saved fraction.
+    """
+    trials = _read_json_dir(Path(store_dir) / "trials")
+    epochs = sum(trial["epochs"] for trial in trials.values())
+    full_epochs = sum(trial["max_epochs"] for trial in trials.values())
+    return {
+        "trials": len(trials),
+        "stopped": sum(trial["stopped"] for trial in trials.values()),
+        "epochs": epochs,
+        "full_epochs": full_epochs,
+        "saved": 1 - epochs / full_epochs if full_epochs else 0.0,
+    }
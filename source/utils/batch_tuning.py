@@ -0,0 +1,236 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+This module chooses the training batch size by measuring the throughput of training steps on the device.
+
+Batch sizes are probed in powers of two until the device runs out of memory, the maximum is reached
+or the throughput stops improving. The smallest batch size that reaches all but a tolerance of the best
+throughput is chosen, since a smaller batch size gives more optimizer steps per epoch. The result is
+cached in the host directory, keyed by the model parameters, the device and the input size, so that
+only the first run on a device type pays for the probe:
+
+    data/cache/batch_sizes.json     chosen batch size and measured throughputs per key
+"""
+
+import fcntl
+import json
+import os
+import time
+from pathlib import Path, PosixPath
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+import torch
+
+
+def return_cache_file() -> PosixPath:
+    """
+    Returns the cache file in the host directory (DEFAULT_DIR), or in the working directory if
+    DEFAULT_DIR is not set.
+
+    Returns:
+        PosixPath: The path to the cache file.
+    """
+    return Path(os.getenv("DEFAULT_DIR", os.getcwd())) / "data" / "cache" / "batch_sizes.json"
+
+
+def device_descriptor(device: torch.device) -> str:
+    """Returns the device type, including the model name for CUDA devices, whose memory and speed differ."""
+    if device.type == "cuda":
+        return f"cuda:{torch.cuda.get_device_name(device)}"
+    return device.type
+
+
+def _synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+
+def _is_out_of_memory(error: RuntimeError) -> bool:
+    message = str(error)
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def _make_batch(batch_size: int, input_size: int, mode: str, segment_length: int, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Creates a random batch with the shapes of the batchers of the training mode."""
+    if mode == "segment":
+        segments = max(1, batch_size // segment_length)
+        return (
+            torch.randn(segments, 1, segment_length + input_size - 1, device=device),
+            torch.randn(segments, segment_length, device=device),
+        )
+    return torch.randn(batch_size, 1, input_size, device=device), torch.randn(batch_size, 1, device=device)
+
+
+def measure_throughput(
+    forward: torch.nn.Module, batch: Tuple[torch.Tensor, torch.Tensor], device: torch.device, min_seconds: float = 0.5, min_steps: int = 3
+) -> float:
+    """
+    Measures the samples/s of training steps (forward, backward and Adam step) on one batch.
+
+    Args:
+        forward (torch.nn.Module): The module that maps a batch to predictions.
+        batch (Tuple[torch.Tensor, torch.Tensor]): The inputs and targets on the device.
+        device (torch.device): The device of the module.
+        min_seconds (float): Minimum duration of the measurement. Defaults to 0.5.
+        min_steps (int): Minimum number of timed steps. Defaults to 3.
+
+    Returns:
+        float: The number of targets per second.
+    """
+    X, y = batch
+    loss_fn = torch.nn.MSELoss()
+    optimizer = torch.optim.Adam(forward.parameters())
+
+    def step():
+        loss = loss_fn(forward(X), y)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    # The first step allocates the gradients and the optimizer state
+    step()
+    _synchronize(device)
+    steps = 0
+    start = time.perf_counter()
+    while steps < min_steps or time.perf_counter() - start < min_seconds:
+        step()
+        steps += 1
+        _synchronize(device)
+    return steps * y.numel() / (time.perf_counter() - start)
+
+
+def probe_batch_sizes(
+    create_forward: Callable[[], torch.nn.Module],
+    input_size: int,
+    device: torch.device,
+    mode: str = "window",
+    segment_length: int = 512,
+    min_batch_size: int = 256,
+    max_batch_size: int = 65536,
+    tolerance: float = 0.05,
+) -> Dict[int, float]:
+    """
+    Measures the throughput of increasing batch sizes (powers of two).
+
+    Probing stops at the maximum, when the device runs out of memory or when two consecutive batch sizes
+    do not improve the best throughput by more than the tolerance.
+
+    Args:
+        create_forward (Callable[[], torch.nn.Module]): Creates a fresh module on the device, as trained in train.py.
+        input_size (int): Number of input samples per window.
+        device (torch.device): The device to probe.
+        mode (str): The training mode, 'window' or 'segment'. Defaults to 'window'.
+        segment_length (int): Targets per segment in the segment mode. Defaults to 512.
+        min_batch_size (int): The first batch size. Defaults to 256.
+        max_batch_size (int): The largest batch size. Defaults to 65536.
+        tolerance (float): Relative improvement that counts as faster. Defaults to 0.05.
+
+    Returns:
+        Dict[int, float]: The samples/s per batch size that fit into memory.
+    """
+    throughputs: Dict[int, float] = {}
+    best = 0.0
+    without_improvement = 0
+    batch_size = min_batch_size
+    while batch_size <= max_batch_size and without_improvement < 2:
+        try:
+            forward = create_forward()
+            batch = _make_batch(batch_size, input_size, mode, segment_length, device)
+            throughput = measure_throughput(forward, batch, device)
+        except RuntimeError as e:
+            # torch.cuda.OutOfMemoryError is a RuntimeError as well
+            if not _is_out_of_memory(e):
+                raise
+            print(f"Batch size {batch_size}: out of memory.")
+            break
+        finally:
+            forward = batch = None
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+        print(f"Batch size {batch_size}: {throughput:.0f} samples/s")
+        throughputs[batch_size] = throughput
+        without_improvement = 0 if throughput > best * (1 + tolerance) else without_improvement + 1
+        best = max(best, throughput)
+        batch_size *= 2
+    if not throughputs:
+        raise RuntimeError(f"Not even a batch size of {min_batch_size} fits into the memory of the {device.type} device.")
+    return throughputs
+
+
+def select_batch_size(throughputs: Dict[int, float], tolerance: float = 0.05) -> int:
+    """Returns the smallest batch size whose throughput is within the tolerance of the best throughput."""
+    best = max(throughputs.values())
+    return min(batch_size for batch_size, throughput in throughputs.items() if throughput >= (1 - tolerance) * best)
+
+
+def _read_cache(cache_file: Path) -> Dict[str, Any]:
+    try:
+        with open(cache_file, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def tuned_batch_size(
+    model_params: Dict[str, Any],
+    create_forward: Callable[[], torch.nn.Module],
+    input_size: int,
+    device: torch.device,
+    mode: str = "window",
+    segment_length: int = 512,
+    cache_file: Optional[Union[str, PosixPath]] = None,
+    **probe_kwargs: Any,
+) -> int:
+    """
+    Returns the cached batch size for the model, device and input size, or probes and caches it.
+
+    Args:
+        model_params (Dict[str, Any]): The model section of the parameters, part of the cache key.
+        create_forward (Callable[[], torch.nn.Module]): Creates a fresh module on the device, see probe_batch_sizes.
+        input_size (int): Number of input samples per window.
+        device (torch.device): The device chosen by config.prepare_device.
+        mode (str): The training mode, 'window' or 'segment'. Defaults to 'window'.
+        segment_length (int): Targets per segment in the segment mode. Defaults to 512.
+        cache_file (Optional[Union[str, PosixPath]]): Defaults to None, which uses return_cache_file().
+        **probe_kwargs: Further arguments of probe_batch_sizes, e.g. max_batch_size.
+
+    Returns:
+        int: The batch size.
+    """
+    cache_file = Path(cache_file or return_cache_file())
+    key = json.dumps({
+        "model": model_params,
+        "device": device_descriptor(device),
+        # On the CPU the throughput depends on the intra-op threads, which config.setup_cpu_runtime sets per job
+        "threads": torch.get_num_threads() if device.type == "cpu" else None,
+        "input_size": input_size,
+        "mode": mode,
+        "segment_length": segment_length if mode == "segment" else None,
+        "probe": probe_kwargs,
+    }, sort_keys=True)
+    cache = _read_cache(cache_file)
+    if key in cache:
+        batch_size = cache[key]["batch_size"]
+        print(f"Using the tuned batch size {batch_size} from {cache_file}.")
+        return batch_size
+
+    print(f"Tuning the batch size on the {device_descriptor(device)} device...")
+    # The probe must not change the random numbers of the training, so that runs with a cached result are identical
+    with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+        throughputs = probe_batch_sizes(create_forward, input_size, device, mode, segment_length, **probe_kwargs)
+    batch_size = select_batch_size(throughputs, probe_kwargs.get("tolerance", 0.05))
+    print(f"Tuned batch size: {batch_size} ({throughputs[batch_size]:.0f} samples/s).")
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_file.with_name(cache_file.name + ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        cache = _read_cache(cache_file)
+        cache[key] = {"batch_size": batch_size, "throughputs": {str(size): value for size, value in throughputs.items()}, "created": time.time()}
+        tmp_path = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(cache, file, indent=2)
+        os.replace(tmp_path, cache_file)
+    return batch_size
@@ -0,0 +1,184 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+This module handles periodic training checkpoints for resuming interrupted experiments.
+"""
+
+import os
+import random
+import signal
+import threading
+from pathlib import Path, PosixPath
+from typing import Any, Dict, Optional, Union
+
+import numpy as np
+import torch
+
+if __name__ == "__main__":
+    import config
+    import distributed
+else:
+    from utils import config, distributed
+
+
+def return_checkpoint_dir() -> PosixPath:
+    """
+    Returns the directory for the resume checkpoints of the current experiment.
+    The directory is located in the host directory, so it outlives the temporary experiment directory,
+    and is named after the DVC experiment, so a resubmitted experiment with the same name resumes.
+
+    Returns:
+        PosixPath: The path to the checkpoint directory.
+    """
+    default_dir = config.get_env_variable("DEFAULT_DIR")
+    dvc_exp_name = config.get_env_variable("DVC_EXP_NAME")
+    return Path(f"{default_dir}/logs/checkpoints/{dvc_exp_name}")
+
+
+def _to_cpu(obj: Any) -> Any:
+    """Recursively copies all tensors in a nested structure to the CPU, detached from the originals."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().clone() if obj.device.type == "cpu" else obj.detach().cpu()
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_states() -> Dict[str, Any]:
+    """Returns the states of the random number generators of random, numpy and torch."""
+    states = {
+        "random": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: Dict[str, Any]) -> None:
+    """Restores the random number generator states returned by get_rng_states."""
+    random.setstate(states["random"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+class CheckpointManager:
+    """
+    Writes checkpoints from a background thread so that training does not block on disk.
+
+    save() takes a CPU snapshot of the state on the calling thread and hands it to the writer thread.
+    If a snapshot is still pending when a newer one arrives, only the newer one is written.
+    Each checkpoint atomically replaces 'latest.pt' in the checkpoint directory.
+
+    Args:
+        checkpoint_dir (Union[str, PosixPath]): Directory where the checkpoint is stored.
+    """
+
+    def __init__(self, checkpoint_dir: Union[str, PosixPath]):
+        self.path = Path(checkpoint_dir) / "latest.pt"
+        self._pending: Optional[Dict[str, Any]] = None
+        self._writing = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def save(self, state: Dict[str, Any]) -> None:
+        """
+        Schedules a checkpoint of the state.
+
+        Args:
+            state (Dict[str, Any]): The state to save. Tensors are copied to the CPU before returning.
+        """
+        snapshot = _to_cpu(state)
+        with self._condition:
+            self._pending = snapshot
+            self._condition.notify_all()
+
+    def _worker(self) -> None:
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                snapshot, self._pending = self._pending, None
+                self._writing = True
+            try:
+                self._write(snapshot)
+            except Exception as e:
+                print(f"Writing checkpoint to {self.path} failed: {e}")
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+    def _write(self, snapshot: Dict[str, Any]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        torch.save(snapshot, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def wait(self) -> None:
+        """Blocks until all scheduled checkpoints are written."""
+        with self._condition:
+            while self._pending is not None or self._writing:
+                self._condition.wait()
+
+    def close(self) -> None:
+        """Writes the pending checkpoint and stops the writer thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """
+        Loads the latest checkpoint.
+
+        Returns:
+            Optional[Dict[str, Any]]: The checkpoint, or None if there is none.
+        """
+        if not self.path.exists():
+            return None
+        return torch.load(self.path, map_location="cpu", weights_only=False)
+
+    def remove(self) -> None:
+        """Removes the checkpoint, e.g. after the experiment finished."""
+        self.wait()
+        self.path.unlink(missing_ok=True)
+
+
+class StopSignal:
+    """
+    Turns termination signals into a flag that the training loop polls.
+    SLURM sends SIGTERM to all processes of a job before killing it on timeout or preemption.
+
+    Args:
+        signals (tuple): The signals to handle. Defaults to (signal.SIGTERM,).
+    """
+
+    def __init__(self, signals: tuple = (signal.SIGTERM,)):
+        self.received: Optional[int] = None
+        for sig in signals:
+            signal.signal(sig, self._handler)
+
+    def _handler(self, signum: int, frame: Any) -> None:
+        print(f"Received signal {signum}, stopping at the next logged batch.")
+        self.received = signum
+
+    def check(self) -> bool:
+        """
+        Returns True if training should stop. In distributed training all ranks have to stop at the same
+        batch, so the flag is combined across ranks, which makes this a collective call.
+        """
+        received = distributed.all_reduce_max(self.received or 0)
+        if received and self.received is None:
+            self.received = int(received)
+        return self.received is not None
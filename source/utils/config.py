@@ -4,16 +4,24 @@
 
 """
 This module handles the configuration for the python project.
+
+torch is only imported by the functions that need it, so that loading the parameters and reading
+environment variables stays fast for the stages that do not use torch.
 """
 
 import copy
+import hashlib
+import json
 import os
+import sys
 from collections.abc import MutableMapping
-from typing import Any, Dict, Generator, Tuple
+from typing import TYPE_CHECKING, Any, Dict, Generator, List, Optional, Tuple
 
-import torch
 from ruamel.yaml import YAML
 
+if TYPE_CHECKING:
+    import torch
+
 
 def get_env_variable(var_name: str) -> str:
     """
@@ -124,8 +132,53 @@ class Params(dict):
         params_dict: Dict[str, Any] = copy.deepcopy(self)
         return self._flatten_dict(params_dict)
 
+    def hash(self, keys: Optional[List[str]] = None) -> str:
+        """
+        Computes a stable SHA-256 hash of the parameters.
+
+        Args:
+            keys (Optional[List[str]]): Flattened keys or key prefixes (e.g. 'preprocess' or
+                'general.input_size') to include. Defaults to None, which hashes all parameters.
+
+        Returns:
+            str: The hexadecimal digest.
+        """
+        flat_params = self.flattened_copy()
+        if keys is not None:
+            flat_params = {
+                k: v
+                for k, v in flat_params.items()
+                if any(k == key or k.startswith(key + ".") for key in keys)
+            }
+        serialized = json.dumps(flat_params, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def with_overrides(self, overrides: Dict[str, Any]) -> "Params":
+        """
+        Creates a copy of the parameters with some values replaced, like 'dvc exp run -S' does.
+
+        Args:
+            overrides (Dict[str, Any]): New values by flattened key, e.g. {'train.batch_size': 2048}.
 
-def prepare_device(request: str) -> torch.device:
+        Returns:
+            Params: The modified copy.
+
+        Raises:
+            KeyError: If a key does not exist in the parameters.
+        """
+        params = copy.deepcopy(self)
+        for key, value in overrides.items():
+            *parents, leaf = key.split(".")
+            section = params
+            for parent in parents:
+                section = section.get(parent) if isinstance(section, MutableMapping) else None
+            if not isinstance(section, MutableMapping) or leaf not in section:
+                raise KeyError(f"The parameter {key} does not exist.")
+            section[leaf] = value
+        return params
+
+
+def prepare_device(request: str) -> "torch.device":
     """
     Prepares the appropriate PyTorch device based on the user's request.
 
@@ -146,6 +199,8 @@ def prepare_device(request: str) -> torch.device:
     Example:
         device = prepare_device("cuda")
     """
+    import torch
+
     if request == "mps":
         if torch.backends.mps.is_available():
             device = torch.device("mps")
@@ -166,6 +221,83 @@ def prepare_device(request: str) -> torch.device:
     return device
 
 
+def available_cpus() -> List[int]:
+    """
+    Returns the CPUs this process may run on, i.e. its CPU affinity, which SLURM restricts to the
+    allocated cores when tasks are bound. Returns all CPUs on systems without affinity support.
+
+    Returns:
+        List[int]: The sorted CPU ids.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def setup_cpu_runtime(
+    pin: bool = False,
+    inter_op_threads: int = 1,
+    dataloader_workers: int = 0,
+) -> Dict[str, Any]:
+    """
+    Configures the PyTorch CPU threads for the CPUs allocated to this process, so that several jobs or
+    processes sharing a node do not oversubscribe its cores.
+
+    The CPU budget is the number of CPUs in the affinity mask, limited by SLURM_CPUS_PER_TASK and by
+    OMP_NUM_THREADS (set by the sweep engine when several trials share an allocation). Processes started
+    by torchrun on the same node (LOCAL_WORLD_SIZE) divide the budget. The DataLoader workers get their
+    own CPUs, the remaining CPUs are used by the intra-op threads.
+
+    Args:
+        pin (bool): Pins the process to its CPUs, for torchrun processes to a separate slice per local rank.
+            Defaults to False.
+        inter_op_threads (int): Threads for running independent operations in parallel. Defaults to 1.
+        dataloader_workers (int): CPUs reserved for DataLoader worker processes. Defaults to 0.
+
+    Returns:
+        Dict[str, Any]: The chosen configuration, e.g. to log it with the hyperparameters.
+
+    Note:
+        Must be called before any parallel work, since PyTorch fixes the inter-op threads on first use.
+    """
+    import torch
+
+    cpus = available_cpus()
+    budget, source = len(cpus), "affinity"
+    for var_name in ("SLURM_CPUS_PER_TASK", "OMP_NUM_THREADS"):
+        value = os.getenv(var_name)
+        if value and int(value) < budget:
+            budget, source = int(value), var_name
+    local_world_size = int(os.getenv("LOCAL_WORLD_SIZE", "1"))
+    local_rank = int(os.getenv("LOCAL_RANK", "0"))
+    budget = max(1, budget // local_world_size)
+
+    dataloader_workers = min(dataloader_workers, budget - 1)
+    intra_op_threads = budget - dataloader_workers
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError:
+        # Already set or parallel work has already started
+        pass
+    pinned_cpus = cpus
+    if pin:
+        pinned_cpus = cpus[local_rank * budget:(local_rank + 1) * budget] or cpus[:budget]
+        os.sched_setaffinity(0, pinned_cpus)
+    runtime = {
+        "cpu_budget": budget,
+        "cpu_budget_source": source,
+        "intra_op_threads": torch.get_num_threads(),
+        "inter_op_threads": torch.get_num_interop_threads(),
+        "dataloader_workers": dataloader_workers,
+        "pinned": pin,
+        "cpus": ",".join(map(str, pinned_cpus)),
+    }
+    print(f"CPU runtime: {runtime['intra_op_threads']} intra-op and {runtime['inter_op_threads']} inter-op threads "
+          f"on CPUs {runtime['cpus']} ({budget} CPUs from {source}{', pinned' if pin else ''}).")
+    return runtime
+
+
 def set_random_seeds(random_seed: int) -> None:
     """
     Sets the random seed for various libraries to ensure reproducibility.
@@ -194,8 +326,10 @@ def set_random_seeds(random_seed: int) -> None:
     else:
         print("The 'numpy' package is not imported, skipping numpy seed.")
 
-    if "torch" in globals():
-        torch.manual_seed(random_seed)  # type: ignore
+    # torch is not imported by this module, it is seeded if the caller has imported it
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.manual_seed(random_seed)
         if torch.cuda.is_available():
             torch.cuda.manual_seed_all(random_seed)
         if torch.backends.mps.is_available():
@@ -0,0 +1,274 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+This module implements a content-addressed cache of preprocessed datasets shared by all experiments.
+
+Every experiment runs in a fresh copy of the repository, so without the cache the preprocessing stage
+decodes the same audio files again for every experiment. The cache lives in the host directory and is
+keyed by the content of the raw audio files, the parameters and the source code of the preprocessing:
+
+    entries/<key>/              the files of a preprocessed dataset and meta.json
+    staging/                    entries under construction, renamed into entries/ when complete
+    file_hashes.json            content hashes of raw files by inode, size and modification time
+    stats.json                  hit and miss counters
+    lock                        lock file for eviction and the shared JSON files
+
+Entries appear atomically by renaming a complete staging directory, so concurrent jobs never read a
+partial entry. If two jobs populate the same key, the first rename wins. Files are hardlinked into and
+out of the cache where possible, otherwise copied. The least recently used entries are evicted once
+the cache exceeds its size limit.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path, PosixPath
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+HASH_CHUNK_SIZE = 2**24
+
+
+def return_cache_dir() -> PosixPath:
+    """
+    Returns the cache directory in the host directory (DEFAULT_DIR), or in the working directory if
+    DEFAULT_DIR is not set.
+
+    Returns:
+        PosixPath: The path to the cache directory.
+    """
+    return Path(os.getenv("DEFAULT_DIR", os.getcwd())) / "data" / "cache"
+
+
+def file_digest(path: Union[str, PosixPath], chunk_size: int = HASH_CHUNK_SIZE) -> str:
+    """Returns the SHA-256 hex digest of the content of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link_or_copy(source: Path, destination: Path) -> None:
+    # A hardlink shares the data, which is safe because cached files are never modified in place
+    destination.unlink(missing_ok=True)
+    try:
+        os.link(source, destination)
+    except OSError:
+        tmp_path = destination.with_name(f"{destination.name}.{uuid.uuid4().hex}.tmp")
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, destination)
+
+
+class DatasetCache:
+    """
+    A content-addressed cache of preprocessed datasets with LRU eviction.
+
+    Args:
+        cache_dir (Union[str, PosixPath]): The cache directory, shared by all experiments on the host.
+        max_bytes (int): The size limit of the cache. The least recently used entries are evicted above it.
+    """
+
+    def __init__(self, cache_dir: Union[str, PosixPath], max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        for name in ("entries", "staging"):
+            (self.cache_dir / name).mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> Optional["DatasetCache"]:
+        """
+        Creates the cache with the size limit in GB from TUSTU_PREPROCESS_CACHE_SIZE.
+
+        Returns:
+            Optional[DatasetCache]: The cache, or None if the variable is unset or 0.
+        """
+        size = float(os.getenv("TUSTU_PREPROCESS_CACHE_SIZE", "0"))
+        if size <= 0:
+            return None
+        return cls(return_cache_dir(), int(size * 1e9))
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        with open(self.cache_dir / "lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_json(self, name: str) -> Dict[str, Any]:
+        try:
+            with open(self.cache_dir / name, "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_json(self, name: str, data: Dict[str, Any]) -> None:
+        tmp_path = self.cache_dir / f"{name}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file, indent=2)
+        os.replace(tmp_path, self.cache_dir / name)
+
+    def content_hash(self, path: Union[str, PosixPath]) -> str:
+        """
+        Returns the SHA-256 digest of a file. The digest is remembered by device, inode, size and
+        modification time, so files that DVC links from its cache are only hashed once.
+        """
+        stat = os.stat(path)
+        stat_key = f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+        digest = self._read_json("file_hashes.json").get(stat_key)
+        if digest is None:
+            digest = file_digest(path)
+            with self._lock():
+                file_hashes = self._read_json("file_hashes.json")
+                file_hashes[stat_key] = digest
+                self._write_json("file_hashes.json", file_hashes)
+        return digest
+
+    def key(self, raw_files: List[Union[str, PosixPath]], params_hash: str, code_files: List[Union[str, PosixPath]]) -> str:
+        """
+        Computes the cache key of a preprocessed dataset.
+
+        Args:
+            raw_files (List[Union[str, PosixPath]]): The raw audio files, hashed by content.
+            params_hash (str): The hash of the parameters that affect the preprocessing.
+            code_files (List[Union[str, PosixPath]]): The source files of the preprocessing, i.e. the code version.
+
+        Returns:
+            str: The hexadecimal key.
+        """
+        digest = hashlib.sha256()
+        for path in raw_files:
+            digest.update(self.content_hash(path).encode())
+        digest.update(params_hash.encode())
+        for path in code_files:
+            digest.update(file_digest(path).encode())
+        return digest.hexdigest()
+
+    def _record(self, outcome: str) -> None:
+        with self._lock():
+            self._record_locked(outcome)
+
+    def _record_locked(self, outcome: str) -> None:
+        stats = self._read_json("stats.json")
+        stats[outcome] = stats.get(outcome, 0) + 1
+        self._write_json("stats.json", stats)
+
+    def fetch(self, key: str, output_dir: Union[str, PosixPath], files: List[str]) -> bool:
+        """
+        Places the files of a cached dataset in output_dir and records a hit or a miss.
+
+        Args:
+            key (str): The key returned by key().
+            output_dir (Union[str, PosixPath]): The directory to place the files in.
+            files (List[str]): The names of the files of the dataset.
+
+        Returns:
+            bool: True on a hit, False if the dataset is not cached.
+        """
+        entry = self.cache_dir / "entries" / key
+        try:
+            for name in files:
+                _link_or_copy(entry / name, Path(output_dir) / name)
+            # The modification time of an entry is its last use for the LRU eviction
+            os.utime(entry)
+        except FileNotFoundError:
+            self._record("misses")
+            return False
+        self._record("hits")
+        return True
+
+    def store(self, key: str, output_dir: Union[str, PosixPath], files: List[str]) -> None:
+        """
+        Adds the files of a preprocessed dataset in output_dir to the cache and evicts old entries if needed.
+
+        Args:
+            key (str): The key returned by key().
+            output_dir (Union[str, PosixPath]): The directory containing the files.
+            files (List[str]): The names of the files of the dataset.
+        """
+        staging = self.cache_dir / "staging" / f"{key}.{uuid.uuid4().hex}"
+        staging.mkdir()
+        try:
+            for name in files:
+                _link_or_copy(Path(output_dir) / name, staging / name)
+            size = sum((staging / name).stat().st_size for name in files)
+            with open(staging / "meta.json", "w") as file:
+                json.dump({"files": files, "size": size, "created": time.time()}, file, indent=2)
+            os.rename(staging, self.cache_dir / "entries" / key)
+        except OSError:
+            # Another job stored the same key first
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict(keep=key)
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """Returns key, size and last use of all entries, least recently used first."""
+        entries = []
+        for entry in (self.cache_dir / "entries").iterdir():
+            try:
+                with open(entry / "meta.json", "r") as file:
+                    size = json.load(file)["size"]
+                entries.append({"key": entry.name, "size": size, "last_used": entry.stat().st_mtime})
+            except (OSError, json.JSONDecodeError, KeyError):
+                continue
+        return sorted(entries, key=lambda entry: entry["last_used"])
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Removes the least recently used entries, except keep, until the cache fits its size limit."""
+        with self._lock():
+            entries = self.entries()
+            total = sum(entry["size"] for entry in entries)
+            for entry in entries:
+                if total <= self.max_bytes:
+                    break
+                if entry["key"] == keep:
+                    continue
+                # Move the entry out of entries/ first, so a concurrent fetch sees either all files or a miss
+                trash = self.cache_dir / "staging" / f"{entry['key']}.{uuid.uuid4().hex}.evicted"
+                os.rename(self.cache_dir / "entries" / entry["key"], trash)
+                shutil.rmtree(trash, ignore_errors=True)
+                total -= entry["size"]
+                self._record_locked("evictions")
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Returns the hit and miss counters and the size of the cache.
+
+        Returns:
+            Dict[str, Any]: hits, misses, evictions, hit_rate, entries, size and max_size in bytes.
+        """
+        stats = self._read_json("stats.json")
+        hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+        entries = self.entries()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "evictions": stats.get("evictions", 0),
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "entries": len(entries),
+            "size": sum(entry["size"] for entry in entries),
+            "max_size": self.max_bytes,
+        }
+
+
+def main():
+    cache = DatasetCache.from_env()
+    if cache is None:
+        print("The preprocessing cache is disabled (TUSTU_PREPROCESS_CACHE_SIZE is unset or 0).")
+        return
+    report = cache.report()
+    print(f"Preprocessing cache {cache.cache_dir}: {report['entries']} entries, "
+          f"{report['size'] / 1e9:.2f} of {report['max_size'] / 1e9:.2f} GB")
+    print(f"{report['hits']} hits, {report['misses']} misses (hit rate {report['hit_rate']:.1%}), "
+          f"{report['evictions']} evictions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+This module handles the setup of distributed data-parallel training.
+"""
+
+import datetime
+import os
+import subprocess
+from typing import Tuple
+
+import torch
+import torch.distributed as dist
+
+
+def get_rank_info() -> Tuple[int, int, int]:
+    """
+    Reads the rank, the world size and the local rank of this process from the environment.
+
+    The variables set by torchrun (RANK, WORLD_SIZE, LOCAL_RANK) take precedence. Otherwise the SLURM
+    variables (SLURM_PROCID, SLURM_NTASKS, SLURM_LOCALID) are used if the process was started as part
+    of a job step with srun. The batch script of a job itself is not a job step and runs as a single process.
+
+    Returns:
+        Tuple[int, int, int]: The rank, the world size and the local rank. (0, 1, 0) if not distributed.
+    """
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        return (
+            int(os.environ["RANK"]),
+            int(os.environ["WORLD_SIZE"]),
+            int(os.environ.get("LOCAL_RANK", 0)),
+        )
+    if "SLURM_STEP_ID" in os.environ and "SLURM_PROCID" in os.environ:
+        return (
+            int(os.environ["SLURM_PROCID"]),
+            int(os.environ["SLURM_NTASKS"]),
+            int(os.environ.get("SLURM_LOCALID", 0)),
+        )
+    return 0, 1, 0
+
+
+def _master_address() -> str:
+    """Returns MASTER_ADDR, or the first host of the SLURM job step's node list."""
+    if "MASTER_ADDR" in os.environ:
+        return os.environ["MASTER_ADDR"]
+    node_list = os.getenv("SLURM_STEP_NODELIST") or os.getenv("SLURM_JOB_NODELIST")
+    if node_list:
+        hostnames = subprocess.run(
+            ["scontrol", "show", "hostnames", node_list],
+            capture_output=True, text=True, check=True,
+        ).stdout.split()
+        return hostnames[0]
+    return "127.0.0.1"
+
+
+def _master_port() -> str:
+    """Returns MASTER_PORT, or a port derived from the SLURM job id so that jobs sharing a node do not collide."""
+    if "MASTER_PORT" in os.environ:
+        return os.environ["MASTER_PORT"]
+    job_id = os.getenv("SLURM_JOB_ID")
+    return str(29500 + int(job_id) % 10000) if job_id else "29500"
+
+
+# The other ranks wait in a collective while rank 0 evaluates the test split and renders audio, which can
+# take longer than the default timeout of the process group (10 minutes for NCCL and 30 for gloo)
+PROCESS_GROUP_TIMEOUT = datetime.timedelta(hours=2)
+
+
+def setup(device: torch.device, timeout: datetime.timedelta = PROCESS_GROUP_TIMEOUT) -> Tuple[int, int, torch.device]:
+    """
+    Initializes the default process group if this process is part of a distributed run.
+    Uses the NCCL backend for CUDA devices and gloo otherwise. On CUDA, each process uses
+    the GPU of its local rank.
+
+    Args:
+        device (torch.device): The device returned by config.prepare_device.
+        timeout (datetime.timedelta): How long a collective waits for the other ranks. Defaults to
+            PROCESS_GROUP_TIMEOUT.
+
+    Returns:
+        Tuple[int, int, torch.device]: The rank, the world size and the device of this process.
+    """
+    rank, world_size, local_rank = get_rank_info()
+    if world_size == 1:
+        return rank, world_size, device
+    if device.type == "cuda":
+        device = torch.device("cuda", local_rank)
+        torch.cuda.set_device(device)
+    os.environ["MASTER_ADDR"] = _master_address()
+    os.environ["MASTER_PORT"] = _master_port()
+    backend = "nccl" if device.type == "cuda" else "gloo"
+    dist.init_process_group(backend=backend, rank=rank, world_size=world_size, timeout=timeout)
+    print(f"Initialized process group ({backend}): rank {rank} of {world_size} on {device}")
+    return rank, world_size, device
+
+
+def is_distributed() -> bool:
+    """Returns True if the default process group is initialized with more than one process."""
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def is_main_process() -> bool:
+    """Returns True for rank 0 or if not distributed. Only the main process writes logs and checkpoints."""
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def _reduce(value: float, op: dist.ReduceOp) -> torch.Tensor:
+    device = torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else None
+    tensor = torch.tensor([value], dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=op)
+    return tensor
+
+
+def all_reduce_mean(value: float) -> float:
+    """Averages a scalar across all processes. Returns the value unchanged if not distributed."""
+    if not is_distributed():
+        return value
+    return _reduce(value, dist.ReduceOp.SUM).item() / dist.get_world_size()
+
+
+def all_reduce_max(value: float) -> float:
+    """Returns the maximum of a scalar across all processes. Returns the value unchanged if not distributed."""
+    if not is_distributed():
+        return value
+    return _reduce(value, dist.ReduceOp.MAX).item()
+
+
+def barrier() -> None:
+    """Waits for all processes if distributed."""
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup() -> None:
+    """Destroys the default process group if it was initialized."""
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
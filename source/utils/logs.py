@@ -4,136 +4,223 @@
 
 
 """
-This module handles the logging and summary writing for the project.
+This module handles the logging for the project: the synchronization and archiving of the logs and
+the aggregation of scalars. The TensorBoard summary writer is in utils.writer and imports torch.
 """
 
 import datetime
-import os
+import math
+import shlex
 import shutil
+import subprocess
+import tempfile
+import threading
 from pathlib import Path, PosixPath
-from typing import Any, Dict, Optional, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Sequence, Union
 
-from torch.utils.tensorboard import SummaryWriter
-from torch.utils.tensorboard.summary import hparams
+if TYPE_CHECKING:
+    from torch.utils.tensorboard import SummaryWriter
 
 if __name__ == "__main__":
     import config
 else:
     from utils import config
 
-class CustomSummaryWriter(SummaryWriter):
+class LogSynchronizer:
     """
-    A custom subclass of the TensorBoard SummaryWriter that allows for logging hyperparameters,
-    displaying scalar metrics in the HParams tab, and automatically synchronizing logs with a remote directory.
+    Synchronizes a log directory with a remote directory using rsync in a background thread.
+
+    Requests are coalesced: at most one rsync runs at a time, and all requests that arrive while it
+    runs are served by a single following rsync. Remote hosts are reached through one persistent SSH
+    connection (ControlMaster) that is opened by the first sync and closed by close(). Every rsync is
+    killed after the timeout, so an unreachable host delays the logs but never the training.
 
     Args:
-        log_dir (Union[str, PosixPath]): Directory where the TensorBoard logs will be stored.
-        params (Optional[config.Params[str, Any]]): config.Params object of DVC hyperparameters to display. Defaults to None.
-        metrics (Optional[Dict[str, None]]): Dictionary of initial metrics to display in the HParams tab. Defaults to {}.
-        sync_interval (Optional[int]): Number of steps between automatic syncs to the remote directory.
-                                       Defaults to the value of the 'TUSTU_SYNC_INTERVAL' environment variable.
-                                       If set to 0, no automatic syncs will be performed.
-        remote_dir (Optional[Union[str, PosixPath]]): Remote directory with format 'host:dir' to which logs are synced.
-                                Defaults to None, in which case the remote directory is constructed from environment variables.
+        log_dir (Union[str, PosixPath]): The local log directory.
+        remote_dir (Union[str, PosixPath]): The target with format 'host:dir', or a local directory.
+        timeout (float): Seconds after which a sync is aborted. Defaults to 120.
     """
 
-    def __init__(
-        self,
-        log_dir: Union[str, PosixPath],
-        params: Optional[config.Params[str, Any]] = None,
-        metrics: Optional[Dict[str, None]] = {},
-        sync_interval: Optional[int] = None,
-        remote_dir: Optional[Union[str, PosixPath]] = None,
-    ):
-        super().__init__(log_dir=log_dir)
-
-        self.sync_interval = (
-            sync_interval
-            if sync_interval is not None
-            else int(config.get_env_variable("TUSTU_SYNC_INTERVAL"))
-        )
-        self.remote_dir = (
-            remote_dir or self._construct_remote_dir()
-            if self.sync_interval != 0
-            else None
-        )
-        self.datetime = self._extract_datetime_from_log_dir(log_dir)
-
-        if params:
-            self._log_hyperparameters(params, metrics, log_dir)
-
-        self.current_step = 0
-
-    def _construct_remote_dir(self) -> str:
-        """Constructs the remote directory path based on environment variables."""
-        tensorboard_host_dir = config.get_env_variable("TUSTU_TENSORBOARD_HOST_DIR")
-        tensorboard_host = config.get_env_variable("TUSTU_TENSORBOARD_HOST")
-        tensorboard_host_savepath = Path(
-            f'{tensorboard_host_dir}/{config.get_env_variable("TUSTU_PROJECT_NAME")}/logs/tensorboard'
-        )
-        os.system(f"ssh {tensorboard_host} 'mkdir -p {tensorboard_host_savepath}'")
-        return f"{tensorboard_host}:{tensorboard_host_savepath}"
-
-    def _extract_datetime_from_log_dir(self, log_dir: Union[str, PosixPath]) -> str:
-        """Extracts datetime information from the log directory path."""
-        return str(log_dir).split("/")[-1].split("_")[0]
-
-    def _log_hyperparameters(
-        self,
-        params: config.Params[str, Any],
-        metrics: Dict[str, None],
-        log_dir: str,
-    ) -> None:
-        """Logs hyperparameters and initial metrics to TensorBoard."""
-        params = params.flattened_copy()
-        params["datetime"] = self.datetime
-        self._add_hparams(hparam_dict=params, metric_dict=metrics, run_name=log_dir)
-
-    def step(self) -> None:
+    def __init__(self, log_dir: Union[str, PosixPath], remote_dir: Union[str, PosixPath], timeout: float = 120.0):
+        self.log_dir = str(log_dir)
+        self.remote_dir = str(remote_dir)
+        self.timeout = timeout
+        host, separator, path = self.remote_dir.partition(":")
+        is_remote = bool(separator) and "/" not in host
+        self.host = host if is_remote else None
+        self.remote_path = path if is_remote else self.remote_dir
+        self.control_dir = tempfile.mkdtemp(prefix="tustu-ssh-") if is_remote else None
+        self.syncs = 0
+        self.failures = 0
+        self._prepared = False
+        self._requested = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _ssh_command(self) -> List[str]:
+        return [
+            "ssh",
+            "-o", "BatchMode=yes",
+            "-o", f"ConnectTimeout={max(1, int(self.timeout))}",
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPath={self.control_dir}/%C",
+            "-o", "ControlPersist=yes",
+        ]
+
+    def request(self) -> None:
+        """Requests a sync without waiting for it."""
+        with self._condition:
+            self._requested = True
+            self._condition.notify_all()
+
+    def _worker(self) -> None:
+        while True:
+            with self._condition:
+                while not self._requested and not self._closed:
+                    self._condition.wait()
+                if not self._requested:
+                    return
+                self._requested = False
+            self._sync()
+
+    def _run(self, command: List[str]) -> bool:
+        try:
+            subprocess.run(command, timeout=self.timeout, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except subprocess.TimeoutExpired:
+            print(f"Log sync to {self.remote_dir} timed out after {self.timeout} s.")
+            return False
+        except (subprocess.CalledProcessError, OSError) as e:
+            stderr = getattr(e, "stderr", None)
+            print(f"Log sync to {self.remote_dir} failed: {stderr.decode().strip() if stderr else e}")
+            return False
+        return True
+
+    def _sync(self) -> bool:
+        """Runs one rsync, creating the remote directory first if needed. Returns True on success."""
+        if not self._prepared:
+            if self.host is None:
+                Path(self.remote_path).mkdir(parents=True, exist_ok=True)
+                self._prepared = True
+            else:
+                self._prepared = self._run([*self._ssh_command(), self.host, f"mkdir -p {shlex.quote(self.remote_path)}"])
+        command = ["rsync", "-r", "--inplace", f"--timeout={max(1, int(self.timeout))}", self.log_dir, self.remote_dir]
+        if self.host is not None:
+            command[1:1] = ["-e", shlex.join(self._ssh_command())]
+        success = self._prepared and self._run(command)
+        self.syncs += 1
+        self.failures += not success
+        return success
+
+    def close(self) -> bool:
         """
-        Increments the current step and triggers log synchronization if the sync interval is reached.
+        Stops the background thread after the pending sync and runs a final sync of the current state.
+
+        Returns:
+            bool: True if the final sync succeeded.
         """
-        self.current_step += 1
-        if self.sync_interval != 0:
-            if self.current_step % self.sync_interval == 0:
-                self.flush()
-                self._sync_logs()
-
-    def _sync_logs(self) -> None:
-        """Synchronizes the logs with the remote directory."""
-        # path = f'mkdir -p {self.remote_dir} && rsync'
-        os.system(f"rsync -rv --inplace --progress {self.log_dir} {self.remote_dir}")
-
-    def _add_hparams(
-        self,
-        hparam_dict: Dict[str, Any],
-        metric_dict: Dict[str, Optional[float]],
-        hparam_domain_discrete: Optional[Dict[str, list]] = None,
-        run_name: Optional[str] = None,
-    ) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        success = self._sync()
+        if self.host is not None:
+            subprocess.run(
+                [*self._ssh_command(), "-O", "exit", self.host],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=self.timeout,
+            )
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+        return success
+
+
+class MetricsRecorder:
+    """
+    Aggregates high-frequency scalars, e.g. batch losses, before they are written to TensorBoard.
+
+    The values of a tag are aggregated into windows of consecutive steps. For every window the mean is
+    written under the tag itself, so it keeps working as a metric in the HParams tab, and the minimum,
+    maximum and last value under '<tag>_min', '<tag>_max' and '<tag>_last', all at the last step of the
+    window. If the total number of steps of a tag is configured, the window is chosen so that at most
+    budget points are written for the tag. Completed windows are buffered and written in batches.
+
+    Args:
+        writer (SummaryWriter): The writer of the events.
+        budget (int): Maximum number of points per tag if its total number of steps is configured. Defaults to 1000.
+        window (int): Window size of tags without a configured total. Defaults to 100.
+        write_batch_size (int): Number of buffered windows that triggers a write. Defaults to 64.
+    """
+
+    def __init__(self, writer: "SummaryWriter", budget: int = 1000, window: int = 100, write_batch_size: int = 64):
+        self.writer = writer
+        self.budget = budget
+        self.default_window = window
+        self.write_batch_size = write_batch_size
+        self.windows: Dict[str, int] = {}
+        self._open: Dict[str, List[float]] = {}
+        self._last_step: Dict[str, int] = {}
+        self._pending: List[tuple] = []
+
+    def configure(self, tag: str, total_steps: int) -> int:
         """
-        Adds hyperparameters and metrics to the same TensorBoard log file and enables scalar metrics in the HParams tab.
+        Sets the window of a tag so that total_steps values result in at most budget points.
 
-        Args:
-            hparam_dict (Dict[str, float]): Dictionary of hyperparameters.
-            metric_dict (Dict[str, Optional[float]]): Dictionary of metrics.
-            hparam_domain_discrete (Optional[Dict[str, list]]): Discrete domains for hyperparameters.
-            run_name (Optional[str]): Name of the run in TensorBoard.
+        Returns:
+            int: The window size.
+        """
+        self.windows[tag] = max(1, math.ceil(total_steps / self.budget))
+        return self.windows[tag]
 
-        Raises:
-            TypeError: If `hparam_dict` or `metric_dict` are not dictionaries.
+    def add(self, tag: str, values: Sequence[float], first_step: int) -> None:
         """
-        if not isinstance(hparam_dict, dict) or not isinstance(metric_dict, dict):
-            raise TypeError("hparam_dict and metric_dict should be dictionary.")
+        Adds the values of consecutive steps starting at first_step.
 
-        exp, ssi, sei = hparams(hparam_dict, metric_dict, hparam_domain_discrete)
+        Args:
+            tag (str): The scalar tag.
+            values (Sequence[float]): The values.
+            first_step (int): The global step of the first value.
+        """
+        window = self.windows.get(tag, self.default_window)
+        open_values = self._open.setdefault(tag, [])
+        for step, value in enumerate(values, first_step):
+            open_values.append(value)
+            self._last_step[tag] = step
+            if len(open_values) == window:
+                self._close_window(tag)
+        if len(self._pending) >= self.write_batch_size:
+            self.flush()
+
+    def _close_window(self, tag: str) -> None:
+        values = self._open[tag]
+        if values:
+            self._pending.append((tag, self._last_step[tag], sum(values) / len(values), min(values), max(values), values[-1]))
+            values.clear()
+
+    def flush(self, partial: bool = False) -> None:
+        """
+        Writes the buffered windows.
 
-        self.file_writer.add_summary(exp)
-        self.file_writer.add_summary(ssi)
-        self.file_writer.add_summary(sei)
-        for k, v in metric_dict.items():
-            if v is not None:
-                self.add_scalar(k, v)
+        Args:
+            partial (bool): Also closes and writes the incomplete windows, e.g. at the end of training. Defaults to False.
+        """
+        if partial:
+            for tag in self._open:
+                self._close_window(tag)
+        for tag, step, mean, minimum, maximum, last in self._pending:
+            self.writer.add_scalar(tag, mean, step)
+            self.writer.add_scalar(f"{tag}_min", minimum, step)
+            self.writer.add_scalar(f"{tag}_max", maximum, step)
+            self.writer.add_scalar(f"{tag}_last", last, step)
+        self._pending = []
+
+
+def __getattr__(name: str) -> Any:
+    # The writer classes import torch, they are loaded from utils.writer on first use
+    if name in ("CustomSummaryWriter", "MediaLogger"):
+        from utils import writer
+
+        return getattr(writer, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def return_tensorboard_path() -> PosixPath:
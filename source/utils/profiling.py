@@ -0,0 +1,241 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+This module records where the time of the training stage goes.
+
+The wall time and the number of samples of every epoch of the training and the test pass are always
+recorded, which costs one timer per epoch. With profile.enabled in params.yaml, the steps are split
+into phases (data, forward, backward, optimizer, logging, ...). The device is synchronized at every
+phase boundary, so that asynchronous GPU work is attributed to the phase that launched it, which is
+why the phases are opt-in. With profile.trace_steps > 0, a window of training steps is additionally
+recorded with torch.profiler and exported as a trace to the TensorBoard logs.
+"""
+
+import contextlib
+import json
+import time
+from collections import defaultdict
+from pathlib import Path, PosixPath
+from typing import Any, Dict, Iterable, Iterator, Optional, Union
+
+import torch
+
+
+def _synchronize(device: torch.device) -> None:
+    """Waits for the queued work of the device."""
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+
+class Profiler:
+    """
+    Records the wall times of the epochs and, if enabled, of the phases within the steps.
+
+    Args:
+        device (torch.device): The device of the training, synchronized at phase boundaries.
+        enabled (bool): Records the phases within the steps. Defaults to False.
+        trace_dir (Optional[Union[str, PosixPath]]): Directory of the torch.profiler trace. Defaults to None,
+            in which case no trace is recorded.
+        trace_wait (int): Training steps before the trace starts, so that warm-up steps are skipped. Defaults to 10.
+        trace_steps (int): Training steps recorded in the trace. Defaults to 0, no trace.
+    """
+
+    def __init__(
+        self,
+        device: torch.device,
+        enabled: bool = False,
+        trace_dir: Optional[Union[str, PosixPath]] = None,
+        trace_wait: int = 10,
+        trace_steps: int = 0,
+    ):
+        self.device = device
+        self.enabled = enabled
+        self.times: Dict[str, float] = defaultdict(float)
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.samples: Dict[str, int] = defaultdict(int)
+        self.totals: Dict[str, Dict[str, float]] = {}
+        self.epochs = 0
+        self._trace = None
+        if trace_dir is not None and trace_steps > 0:
+            self._trace = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU]
+                + ([torch.profiler.ProfilerActivity.CUDA] if device.type == "cuda" else []),
+                # One warm-up step, whose overhead is not recorded
+                schedule=torch.profiler.schedule(wait=max(0, trace_wait - 1), warmup=1, active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(str(trace_dir)),
+                record_shapes=True,
+            )
+            self._trace.start()
+
+    @classmethod
+    def from_params(cls, params: Dict[str, Any], device: torch.device, trace_dir: Optional[Union[str, PosixPath]] = None) -> "Profiler":
+        """
+        Creates the profiler from the profile section of the parameters.
+
+        Args:
+            params (Dict[str, Any]): The parameters with a profile section (enabled, trace_wait, trace_steps).
+                The trace is only recorded if the profiling is enabled.
+            device (torch.device): The device of the training.
+            trace_dir (Optional[Union[str, PosixPath]]): Directory of the trace, e.g. the TensorBoard log
+                directory. Defaults to None, in which case no trace is recorded.
+
+        Returns:
+            Profiler: The profiler.
+        """
+        settings = params.get("profile") or {}
+        enabled = settings.get("enabled", False)
+        return cls(
+            device,
+            enabled=enabled,
+            trace_dir=trace_dir if enabled else None,
+            trace_wait=settings.get("trace_wait", 10),
+            trace_steps=settings.get("trace_steps", 0),
+        )
+
+    def _record(self, name: str, seconds: float, samples: int) -> None:
+        self.times[name] += seconds
+        self.counts[name] += 1
+        self.samples[name] += samples
+
+    @contextlib.contextmanager
+    def epoch(self, name: str, samples: int = 0) -> Iterator[None]:
+        """
+        Times a pass over a dataset, e.g. 'train' or 'test'. Always active.
+
+        Args:
+            name (str): The name of the pass.
+            samples (int): The number of samples processed in the pass. Defaults to 0.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, time.perf_counter() - start, samples)
+
+    def phase(self, name: str) -> contextlib.AbstractContextManager:
+        """
+        Times a phase of a step, e.g. 'train/forward', if the profiler is enabled.
+        The phase also appears as a labeled range in the trace.
+
+        Args:
+            name (str): The name of the phase, prefixed with the name of the pass.
+
+        Returns:
+            contextlib.AbstractContextManager: The context manager that times the phase.
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._phase(name)
+
+    @contextlib.contextmanager
+    def _phase(self, name: str) -> Iterator[None]:
+        _synchronize(self.device)
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+                _synchronize(self.device)
+        finally:
+            self._record(name, time.perf_counter() - start, 0)
+
+    def iterate(self, iterable: Iterable, name: str) -> Iterator[Any]:
+        """
+        Iterates over a data loader and times the loading of each batch as a phase, if the profiler is enabled.
+
+        Args:
+            iterable (Iterable): The data loader.
+            name (str): The name of the phase, e.g. 'train/data'.
+
+        Yields:
+            Any: The batches.
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                batch = next(iterator, None)
+            if batch is None:
+                return
+            yield batch
+
+    def step(self) -> None:
+        """Marks the end of a training step for the trace."""
+        if self._trace is not None:
+            self._trace.step()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Summarizes the recorded times since the last call of end_epoch.
+
+        Returns:
+            Dict[str, Dict[str, float]]: Per pass or phase the seconds, the number of calls, the mean
+                milliseconds per call and, for passes, the throughput in samples per second.
+        """
+        summary = {}
+        for name, seconds in self.times.items():
+            entry = {"seconds": seconds, "calls": self.counts[name], "mean_ms": 1000 * seconds / self.counts[name]}
+            if self.samples[name]:
+                entry["samples_per_second"] = self.samples[name] / seconds if seconds > 0 else 0.0
+            summary[name] = entry
+        return summary
+
+    def end_epoch(self, writer: Optional[Any], epoch: int) -> Dict[str, Dict[str, float]]:
+        """
+        Writes the summary of an epoch to TensorBoard, adds it to the totals and starts the next epoch.
+
+        Args:
+            writer (Optional[Any]): The SummaryWriter, or None on ranks that do not write logs.
+            epoch (int): The epoch, used as the global step.
+
+        Returns:
+            Dict[str, Dict[str, float]]: The summary of the epoch.
+        """
+        summary = self.summary()
+        if writer is not None:
+            for name, entry in summary.items():
+                writer.add_scalar(f"Profile/{name}_seconds", entry["seconds"], epoch)
+                if "samples_per_second" in entry:
+                    writer.add_scalar(f"Throughput/{name}", entry["samples_per_second"], epoch)
+        for name in summary:
+            total = self.totals.setdefault(name, {"seconds": 0.0, "calls": 0, "samples": 0})
+            total["seconds"] += self.times[name]
+            total["calls"] += self.counts[name]
+            total["samples"] += self.samples[name]
+        self.times.clear()
+        self.counts.clear()
+        self.samples.clear()
+        self.epochs += 1
+        return summary
+
+    def close(self) -> None:
+        """Stops the trace, which exports it if the window of steps was not reached yet."""
+        if self._trace is not None:
+            self._trace.stop()
+            self._trace = None
+
+    def save_metrics(self, path: Union[str, PosixPath]) -> None:
+        """
+        Writes the totals of all epochs as a DVC metrics file, so that experiments can be compared with 'dvc exp show'.
+
+        Args:
+            path (Union[str, PosixPath]): The path of the JSON file.
+        """
+        metrics: Dict[str, Any] = {"epochs": self.epochs}
+        train_seconds = self.totals.get("train", {}).get("seconds", 0.0)
+        for name, total in sorted(self.totals.items()):
+            entry = {"seconds": round(total["seconds"], 4), "mean_ms": round(1000 * total["seconds"] / total["calls"], 4)}
+            if total["samples"]:
+                entry["samples_per_second"] = round(total["samples"] / total["seconds"], 1) if total["seconds"] > 0 else 0.0
+            elif name.startswith("train/") and train_seconds > 0:
+                entry["share"] = round(total["seconds"] / train_seconds, 4)
+            metrics[name] = entry
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(metrics, file, indent=2)
@@ -0,0 +1,313 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+This module expands hyperparameter search spaces into trials and runs them, either locally in a
+process pool or packed into the tasks of a single SLURM job array.
+"""
+
+import concurrent.futures
+import itertools
+import json
+import math
+import os
+import random
+import shlex
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from ruamel.yaml import YAML
+
+if __name__ == "__main__":
+    import asha
+    import config
+else:
+    from utils import asha, config
+
+SWEEP_DIR = Path("logs/sweeps")
+FINISHED_DIR = SWEEP_DIR / "finished"
+
+
+def load_sweep_config(yaml_file: str = "sweep.yaml") -> Dict[str, Any]:
+    """
+    Loads and validates a sweep configuration.
+
+    Args:
+        yaml_file (str): The path to the YAML file with the sweep configuration. Defaults to 'sweep.yaml'.
+
+    Returns:
+        Dict[str, Any]: The configuration with defaults for the optional entries.
+
+    Raises:
+        ValueError: If the search method is unknown or the search space is empty.
+    """
+    yaml = YAML(typ="safe")
+    with open(yaml_file, "r") as file:
+        sweep_config = yaml.load(file)
+    sweep_config.setdefault("name", Path(yaml_file).stem)
+    sweep_config.setdefault("method", "grid")
+    sweep_config.setdefault("num_samples", 1)
+    sweep_config.setdefault("seed", 0)
+    sweep_config.setdefault("trials_per_task", 1)
+    sweep_config.setdefault("max_parallel_tasks", None)
+    sweep_config.setdefault("command", "./exp_workflow.sh")
+    sweep_config.setdefault("slurm", {})
+    sweep_config.setdefault("scheduler", None)
+    if sweep_config["method"] not in ("grid", "random"):
+        raise ValueError(f"Unknown search method '{sweep_config['method']}', expected 'grid' or 'random'.")
+    if sweep_config["scheduler"] and sweep_config["scheduler"].get("type") != "asha":
+        raise ValueError(f"Unknown scheduler '{sweep_config['scheduler'].get('type')}', expected 'asha' or null.")
+    if not sweep_config.get("parameters"):
+        raise ValueError(f"The sweep configuration {yaml_file} defines no parameters.")
+    return sweep_config
+
+
+def _sample(spec: Any, rng: random.Random) -> Any:
+    """Draws a value from a list of choices or a distribution given as a dict."""
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    if not isinstance(spec, dict):
+        return spec
+    distribution = spec.get("distribution")
+    if distribution == "choice":
+        return rng.choice(spec["values"])
+    if distribution == "uniform":
+        return rng.uniform(spec["low"], spec["high"])
+    if distribution == "loguniform":
+        return math.exp(rng.uniform(math.log(spec["low"]), math.log(spec["high"])))
+    if distribution == "int":
+        return rng.randint(spec["low"], spec["high"])
+    raise ValueError(f"Unknown distribution '{distribution}', expected 'choice', 'uniform', 'loguniform' or 'int'.")
+
+
+def expand_search_space(sweep_config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Expands the search space into the parameter overrides of the trials.
+
+    For the grid method every parameter is a list of values (or a single fixed value) and the trials are
+    the cartesian product. For the random method num_samples trials are drawn with the given seed, where
+    a parameter is a list to choose from or a dict with a distribution ('choice', 'uniform', 'loguniform'
+    or 'int'). Duplicate trials are removed.
+
+    Args:
+        sweep_config (Dict[str, Any]): The configuration returned by load_sweep_config.
+
+    Returns:
+        List[Dict[str, Any]]: One dict of flattened parameter keys and values per trial.
+    """
+    parameters = sweep_config["parameters"]
+    if sweep_config["method"] == "grid":
+        values = []
+        for key, spec in parameters.items():
+            if isinstance(spec, dict):
+                raise ValueError(f"The grid method needs a list of values for {key}, not a distribution.")
+            values.append(spec if isinstance(spec, list) else [spec])
+        trials = [dict(zip(parameters, combination)) for combination in itertools.product(*values)]
+    else:
+        rng = random.Random(sweep_config["seed"])
+        trials = [{key: _sample(spec, rng) for key, spec in parameters.items()} for _ in range(sweep_config["num_samples"])]
+    unique = {json.dumps(trial, sort_keys=True): trial for trial in trials}
+    return list(unique.values())
+
+
+def format_exp_params(trial: Dict[str, Any]) -> str:
+    """Returns the arguments for 'dvc exp run' that name the experiment and set the trial's parameters."""
+    args = ["-n", trial["name"]]
+    for key, value in trial["overrides"].items():
+        value = json.dumps(value) if value is None or isinstance(value, bool) else value
+        args += ["-S", f"{key}={value}"]
+    return shlex.join(args)
+
+
+def finished_path(trial_hash: str) -> Path:
+    """Returns the path of the record that marks a trial with this parameter hash as finished."""
+    return FINISHED_DIR / f"{trial_hash}.json"
+
+
+def check_scheduler(sweep_config: Dict[str, Any], trial_params: List[config.Params]) -> None:
+    """
+    Checks that the ASHA scheduler of a sweep can rank its trials.
+
+    Args:
+        sweep_config (Dict[str, Any]): The configuration returned by load_sweep_config.
+        trial_params (List[config.Params]): The parameters of every trial.
+
+    Raises:
+        ValueError: If a preprocess parameter is swept, so the test losses are computed on different data,
+            or if a trial has no rung, i.e. its train.epochs is not larger than min_epochs.
+    """
+    scheduler = sweep_config["scheduler"]
+    if not scheduler:
+        return
+    data_parameters = [key for key in sweep_config["parameters"] if key.startswith("preprocess.")]
+    if data_parameters:
+        raise ValueError(f"The asha scheduler ranks trials by test loss, which depends on {', '.join(data_parameters)}. "
+                         "Sweep only train.* and model.* parameters or set the scheduler to null.")
+    min_epochs, reduction_factor = scheduler.get("min_epochs", 1), scheduler.get("reduction_factor", 3)
+    for params in trial_params:
+        if not asha.rung_epochs(min_epochs, reduction_factor, params["train"]["epochs"]):
+            raise ValueError(f"With train.epochs {params['train']['epochs']} and min_epochs {min_epochs} the asha scheduler "
+                             "never compares trials. Increase train.epochs or set the scheduler to null.")
+
+
+def plan_trials(sweep_config: Dict[str, Any], params: config.Params) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Creates the trials of a sweep and leaves out those that already finished.
+
+    A trial is identified by the hash of all parameters with its overrides applied, so trials of
+    different sweeps with the same parameters are only run once. The experiment name contains the hash,
+    so that a resubmitted trial resumes from its training checkpoint.
+
+    Args:
+        sweep_config (Dict[str, Any]): The configuration returned by load_sweep_config.
+        params (config.Params): The default parameters from params.yaml.
+
+    Returns:
+        Tuple[List[Dict[str, Any]], int]: The pending trials and the number of skipped finished trials.
+
+    Raises:
+        ValueError: If the scheduler cannot rank the trials, see check_scheduler.
+    """
+    search_space = expand_search_space(sweep_config)
+    trial_params = [params.with_overrides(overrides) for overrides in search_space]
+    check_scheduler(sweep_config, trial_params)
+    pending, skipped = [], 0
+    for overrides, trial in zip(search_space, trial_params):
+        trial_hash = trial.hash()
+        if finished_path(trial_hash).exists():
+            skipped += 1
+            continue
+        pending.append({"name": f"{sweep_config['name']}-{trial_hash[:8]}", "hash": trial_hash, "overrides": overrides})
+    return pending, skipped
+
+
+def pack_trials(trials: List[Dict[str, Any]], trials_per_task: int) -> List[List[Dict[str, Any]]]:
+    """Splits the trials into groups that run concurrently within one task of the job array."""
+    return [trials[i:i + trials_per_task] for i in range(0, len(trials), trials_per_task)]
+
+
+def _write_json(path: Path, data: Any) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def scheduler_env(sweep_config: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Creates the ASHA store of a sweep with a scheduler and returns the environment variables that point
+    its trials to it. The store is located in logs/sweeps/<name>/asha of the host directory.
+
+    Returns:
+        Dict[str, str]: The environment variables, empty if the sweep has no scheduler.
+    """
+    scheduler = sweep_config["scheduler"]
+    if not scheduler:
+        return {}
+    store_dir = (SWEEP_DIR / sweep_config["name"] / "asha").resolve()
+    asha.write_config(store_dir, scheduler.get("min_epochs", 1), scheduler.get("reduction_factor", 3))
+    return {asha.STORE_ENV_VARIABLE: str(store_dir)}
+
+
+def run_trial(trial: Dict[str, Any], command: str, threads: Optional[int] = None, env: Optional[Dict[str, str]] = None) -> int:
+    """
+    Runs the command of a trial and records the trial as finished if it succeeds.
+    The command receives the trial's 'dvc exp run' arguments in EXP_PARAMS, like exp_workflow.sh expects,
+    and the parameter hash in TUSTU_TRIAL_HASH.
+
+    Args:
+        trial (Dict[str, Any]): A trial returned by plan_trials.
+        command (str): The shell command, e.g. './exp_workflow.sh'.
+        threads (Optional[int]): Limits the intra-op threads of the trial via OMP_NUM_THREADS. Defaults to None.
+        env (Optional[Dict[str, str]]): Additional environment variables, e.g. from scheduler_env. Defaults to None.
+
+    Returns:
+        int: The exit status of the command.
+    """
+    env = {**os.environ, **(env or {}), "EXP_PARAMS": format_exp_params(trial), asha.TRIAL_ENV_VARIABLE: trial["hash"]}
+    if threads is not None:
+        env["OMP_NUM_THREADS"] = str(threads)
+    start = time.time()
+    # Run the command with bash like the original submission (otherwise module not found)
+    returncode = subprocess.run(["bash", "-c", command], env=env).returncode
+    if returncode == 0:
+        _write_json(finished_path(trial["hash"]), {**trial, "command": command, "seconds": time.time() - start})
+    return returncode
+
+
+def run_local(
+    trials: List[Dict[str, Any]], command: str, max_workers: int, threads: Optional[int] = None, env: Optional[Dict[str, str]] = None
+) -> int:
+    """
+    Runs trials concurrently in a process pool.
+
+    Args:
+        trials (List[Dict[str, Any]]): The trials returned by plan_trials.
+        command (str): The shell command of each trial.
+        max_workers (int): The number of trials that run at the same time.
+        threads (Optional[int]): Threads per trial, see run_trial. Defaults to None.
+        env (Optional[Dict[str, str]]): Additional environment variables of each trial. Defaults to None.
+
+    Returns:
+        int: The number of failed trials.
+    """
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_trial, trial, command, threads, env): trial for trial in trials}
+        for future in concurrent.futures.as_completed(futures):
+            trial, returncode = futures[future], future.result()
+            print(f"Trial {trial['name']} {'finished' if returncode == 0 else f'failed with exit status {returncode}'}.")
+            failed += returncode != 0
+    return failed
+
+
+def submit_array(sweep_config: Dict[str, Any], tasks: List[List[Dict[str, Any]]], job_script: str = "slurm_sweep.sh") -> Path:
+    """
+    Writes the tasks of a sweep to logs/sweeps/<name>/tasks.json and submits them as one SLURM job array.
+    Each array task runs its group of trials concurrently with run_task.
+
+    Args:
+        sweep_config (Dict[str, Any]): The configuration returned by load_sweep_config.
+        tasks (List[List[Dict[str, Any]]]): The trial groups returned by pack_trials.
+        job_script (str): The batch script of an array task. Defaults to 'slurm_sweep.sh'.
+
+    Returns:
+        Path: The path of the tasks file.
+    """
+    tasks_file = SWEEP_DIR / sweep_config["name"] / "tasks.json"
+    _write_json(tasks_file, {"command": sweep_config["command"], "env": scheduler_env(sweep_config), "tasks": tasks})
+    array = f"0-{len(tasks) - 1}"
+    if sweep_config["max_parallel_tasks"]:
+        array += f"%{sweep_config['max_parallel_tasks']}"
+    args = ["sbatch", f"--array={array}", f"--job-name={sweep_config['name']}"]
+    args += [f"--{key}={value}" for key, value in sweep_config["slurm"].items()]
+    args += [f"--export=ALL,TUSTU_SWEEP_TASKS={tasks_file}", job_script]
+    # Run sbatch as bash subprocess command (otherwise module not found)
+    subprocess.run(["bash", "-c", shlex.join(args)], check=True)
+    return tasks_file
+
+
+def run_task(tasks_file: str, task_id: int) -> int:
+    """
+    Runs the trials of one array task concurrently. The CPUs of the allocation (SLURM_CPUS_PER_TASK)
+    are divided evenly between the trials.
+
+    Args:
+        tasks_file (str): The tasks file written by submit_array.
+        task_id (int): The array task id (SLURM_ARRAY_TASK_ID).
+
+    Returns:
+        int: The number of failed trials.
+    """
+    with open(tasks_file, "r") as file:
+        sweep_tasks = json.load(file)
+    trials = [trial for trial in sweep_tasks["tasks"][task_id] if not finished_path(trial["hash"]).exists()]
+    if not trials:
+        return 0
+    cpus = os.getenv("SLURM_CPUS_PER_TASK")
+    threads = max(1, int(cpus) // len(trials)) if cpus else None
+    return run_local(trials, sweep_tasks["command"], max_workers=len(trials), threads=threads, env=sweep_tasks["env"])
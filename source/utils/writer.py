@@ -0,0 +1,279 @@
+# Copyright 2024 tu-studio
+# This file is licensed under the Apache License, Version 2.0.
+# See the LICENSE file in the root of this project for details.
+
+"""
+This module provides the TensorBoard summary writer of the training. It is separate from the logs
+module, so that the stages that only archive logs do not import torch.
+"""
+
+import queue
+import threading
+import time
+from pathlib import Path, PosixPath
+from typing import Any, Dict, Optional, Sequence, Union
+
+from torch.utils.tensorboard import SummaryWriter
+from torch.utils.tensorboard.summary import hparams
+
+from utils import config
+from utils.logs import LogSynchronizer, MetricsRecorder
+
+
+class MediaLogger:
+    """
+    Writes media summaries, e.g. audio, in a background thread so that encoding and writing large
+    events does not block the training. The media is written with its own SummaryWriter to a separate
+    event file in the same log directory, so scalar events and flushes never wait behind large media
+    events in the event file queue.
+
+    Submitted items wait in a bounded queue. If the queue is full, the backpressure policy decides:
+    'drop' discards the new item, 'defer' keeps only the newest item per tag aside and submits it
+    once the queue has space again. close() writes everything that is still queued or deferred.
+
+    Args:
+        log_dir (Union[str, PosixPath]): Directory of the TensorBoard logs.
+        max_queue_size (int): Maximum number of queued items. Defaults to 2.
+        backpressure (str): 'drop' or 'defer'. Defaults to 'defer'.
+    """
+
+    def __init__(self, log_dir: Union[str, PosixPath], max_queue_size: int = 2, backpressure: str = "defer"):
+        if backpressure not in ("drop", "defer"):
+            raise ValueError(f"Unknown backpressure policy '{backpressure}', expected 'drop' or 'defer'.")
+        self.writer = SummaryWriter(log_dir=log_dir, filename_suffix=".media")
+        self.backpressure = backpressure
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._deferred: Dict[str, tuple] = {}
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            function, args, kwargs = item
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                print(f"Writing media failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _put_deferred(self) -> None:
+        for tag in list(self._deferred):
+            try:
+                self._queue.put_nowait(self._deferred[tag])
+            except queue.Full:
+                return
+            del self._deferred[tag]
+
+    def submit(self, method: str, tag: str, *args: Any, **kwargs: Any) -> bool:
+        """
+        Queues a call of the SummaryWriter method, e.g. 'add_audio', with the tag and the other arguments.
+
+        Returns:
+            bool: True if the item was queued, False if it was deferred or dropped.
+        """
+        self._put_deferred()
+        item = (getattr(self.writer, method), (tag, *args), kwargs)
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            if self.backpressure == "defer":
+                if tag in self._deferred:
+                    self.dropped += 1
+                self._deferred[tag] = item
+            else:
+                self.dropped += 1
+            return False
+
+    def close(self) -> None:
+        """Writes all queued and deferred items and stops the background thread."""
+        for item in self._deferred.values():
+            self._queue.put(item)
+        self._deferred = {}
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.close()
+        if self.dropped:
+            print(f"Dropped {self.dropped} media items because the media queue was full.")
+
+
+class CustomSummaryWriter(SummaryWriter):
+    """
+    A custom subclass of the TensorBoard SummaryWriter that allows for logging hyperparameters,
+    displaying scalar metrics in the HParams tab, and automatically synchronizing logs with a remote directory.
+
+    Args:
+        log_dir (Union[str, PosixPath]): Directory where the TensorBoard logs will be stored.
+        params (Optional[config.Params[str, Any]]): config.Params object of DVC hyperparameters to display. Defaults to None.
+        metrics (Optional[Dict[str, None]]): Dictionary of initial metrics to display in the HParams tab. Defaults to {}.
+        sync_interval (Optional[int]): Number of steps between automatic syncs to the remote directory.
+                                       Defaults to the value of the 'TUSTU_SYNC_INTERVAL' environment variable.
+                                       If set to 0, no automatic syncs will be performed.
+        remote_dir (Optional[Union[str, PosixPath]]): Remote directory with format 'host:dir' to which logs are synced.
+                                Defaults to None, in which case the remote directory is constructed from environment variables.
+                                A local directory can be used instead of a remote host.
+        sync_timeout (float): Seconds after which a sync is aborted. Defaults to 120.
+        scalar_budget (int): Maximum number of points per aggregated scalar tag, see MetricsRecorder. Defaults to 1000.
+        media_queue_size (int): Maximum number of media items waiting to be written, see MediaLogger. Defaults to 2.
+        media_backpressure (str): 'drop' or 'defer' media items if the queue is full. Defaults to 'defer'.
+        purge_step (Optional[int]): Events of earlier runs in log_dir at or after this step are discarded,
+                                    e.g. when a run resumes from a checkpoint. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        log_dir: Union[str, PosixPath],
+        params: Optional[config.Params[str, Any]] = None,
+        metrics: Optional[Dict[str, None]] = {},
+        sync_interval: Optional[int] = None,
+        remote_dir: Optional[Union[str, PosixPath]] = None,
+        sync_timeout: float = 120.0,
+        scalar_budget: int = 1000,
+        media_queue_size: int = 2,
+        media_backpressure: str = "defer",
+        purge_step: Optional[int] = None,
+    ):
+        super().__init__(log_dir=log_dir, purge_step=purge_step)
+        self.metrics_recorder = MetricsRecorder(self, budget=scalar_budget)
+        self.media_logger = MediaLogger(log_dir, media_queue_size, media_backpressure)
+
+        self.sync_interval = (
+            sync_interval
+            if sync_interval is not None
+            else int(config.get_env_variable("TUSTU_SYNC_INTERVAL"))
+        )
+        self.remote_dir = (
+            remote_dir or self._construct_remote_dir()
+            if self.sync_interval != 0
+            else None
+        )
+        self.synchronizer = (
+            LogSynchronizer(log_dir, self.remote_dir, timeout=sync_timeout)
+            if self.sync_interval != 0
+            else None
+        )
+        self.datetime = self._extract_datetime_from_log_dir(log_dir)
+
+        if params:
+            self._log_hyperparameters(params, metrics, log_dir)
+
+        self.current_step = 0
+
+    def _construct_remote_dir(self) -> str:
+        """Constructs the remote directory path based on environment variables."""
+        tensorboard_host_dir = config.get_env_variable("TUSTU_TENSORBOARD_HOST_DIR")
+        tensorboard_host = config.get_env_variable("TUSTU_TENSORBOARD_HOST")
+        tensorboard_host_savepath = Path(
+            f'{tensorboard_host_dir}/{config.get_env_variable("TUSTU_PROJECT_NAME")}/logs/tensorboard'
+        )
+        # The directory is created by the first sync
+        return f"{tensorboard_host}:{tensorboard_host_savepath}"
+
+    def _extract_datetime_from_log_dir(self, log_dir: Union[str, PosixPath]) -> str:
+        """Extracts datetime information from the log directory path."""
+        return str(log_dir).split("/")[-1].split("_")[0]
+
+    def _log_hyperparameters(
+        self,
+        params: config.Params[str, Any],
+        metrics: Dict[str, None],
+        log_dir: str,
+    ) -> None:
+        """Logs hyperparameters and initial metrics to TensorBoard."""
+        params = params.flattened_copy()
+        # HParams only holds scalars and strings, lists such as several input files are logged as text
+        params = {key: str(value) if isinstance(value, (list, tuple)) else value for key, value in params.items()}
+        params["datetime"] = self.datetime
+        self._add_hparams(hparam_dict=params, metric_dict=metrics, run_name=log_dir)
+
+    def step(self) -> None:
+        """
+        Increments the current step and triggers log synchronization if the sync interval is reached.
+        """
+        self.current_step += 1
+        if self.sync_interval != 0:
+            if self.current_step % self.sync_interval == 0:
+                self.flush()
+                self._sync_logs()
+
+    def add_aggregated_scalars(self, tag: str, values: Sequence[float], first_step: int) -> None:
+        """
+        Adds the values of a high-frequency scalar for consecutive steps, which are aggregated by the MetricsRecorder.
+
+        Args:
+            tag (str): The scalar tag.
+            values (Sequence[float]): The values.
+            first_step (int): The global step of the first value.
+        """
+        self.metrics_recorder.add(tag, values, first_step)
+
+    def add_media_async(self, method: str, tag: str, *args: Any, **kwargs: Any) -> bool:
+        """
+        Writes media with a SummaryWriter method in the background, e.g. add_media_async('add_image', tag, image, step).
+        Tensors should not be modified afterwards, they are encoded later. The event gets the time of the call.
+
+        Returns:
+            bool: True if the item was queued, False if it was deferred or dropped, see MediaLogger.
+        """
+        kwargs.setdefault("walltime", time.time())
+        return self.media_logger.submit(method, tag, *args, **kwargs)
+
+    def add_audio_async(self, tag: str, snd_tensor: Any, global_step: Optional[int] = None, sample_rate: int = 44100) -> bool:
+        """Like add_audio, but encodes and writes the audio in the background. Device tensors are copied to the CPU first."""
+        if hasattr(snd_tensor, "cpu"):
+            snd_tensor = snd_tensor.detach().cpu()
+        return self.add_media_async("add_audio", tag, snd_tensor, global_step, sample_rate=sample_rate)
+
+    def flush(self) -> None:
+        """Writes the completed windows of aggregated scalars and flushes the event file."""
+        self.metrics_recorder.flush()
+        super().flush()
+
+    def _sync_logs(self) -> None:
+        """Requests a background synchronization of the logs with the remote directory."""
+        self.synchronizer.request()
+
+    def close(self) -> None:
+        """Closes the writer and synchronizes the complete logs with the remote directory."""
+        self.media_logger.close()
+        self.metrics_recorder.flush(partial=True)
+        super().close()
+        if self.synchronizer is not None:
+            self.synchronizer.close()
+            self.synchronizer = None
+
+    def _add_hparams(
+        self,
+        hparam_dict: Dict[str, Any],
+        metric_dict: Dict[str, Optional[float]],
+        hparam_domain_discrete: Optional[Dict[str, list]] = None,
+        run_name: Optional[str] = None,
+    ) -> None:
+        """
+        Adds hyperparameters and metrics to the same TensorBoard log file and enables scalar metrics in the HParams tab.
+
+        Args:
+            hparam_dict (Dict[str, float]): Dictionary of hyperparameters.
+            metric_dict (Dict[str, Optional[float]]): Dictionary of metrics.
+            hparam_domain_discrete (Optional[Dict[str, list]]): Discrete domains for hyperparameters.
+            run_name (Optional[str]): Name of the run in TensorBoard.
+
+        Raises:
+            TypeError: If `hparam_dict` or `metric_dict` are not dictionaries.
+        """
+        if not isinstance(hparam_dict, dict) or not isinstance(metric_dict, dict):
+            raise TypeError("hparam_dict and metric_dict should be dictionary.")
+
+        exp, ssi, sei = hparams(hparam_dict, metric_dict, hparam_domain_discrete)
+
+        self.file_writer.add_summary(exp)
+        self.file_writer.add_summary(ssi)
+        self.file_writer.add_summary(sei)
+        for k, v in metric_dict.items():
+            if v is not None:
+                self.add_scalar(k, v)